@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import School, Admin, Student, Staff, Review, Vote, Staff_Inbox, Endorsement, EndorsementStats, Karma, Stats, Activity
+from .models import School, Admin, Student, Staff, Review, Vote, Staff_Inbox, Endorsement, EndorsementStats, Karma, Stats, Activity, LeaderboardExport, ImportJob, LLMCall
 
 # Register your models here.
 
@@ -15,5 +15,8 @@ admin.site.register(EndorsementStats)
 admin.site.register(Karma)
 admin.site.register(Stats)
 admin.site.register(Activity)
+admin.site.register(LeaderboardExport)
+admin.site.register(ImportJob)
+admin.site.register(LLMCall)
 
 # Note: no need to register User model - Django has it registered already
\ No newline at end of file
@@ -0,0 +1,45 @@
+from django.db import IntegrityError, transaction
+from .models import Endorsement, EndorsementStats, Karma, SKILLS
+
+
+# Skill endorsements
+# Each staff member has one Endorsement row per student (unique on staff, student) with a flag for
+# each skill, and endorsing a skill again removes the endorsement. The row is locked with
+# select_for_update while the flag is flipped, and the skill counter and karma are updated in the
+# same transaction (like cast_vote)
+
+
+# the outcome of an endorsement toggle: whether the skill is now endorsed by the staff member,
+# the student's new count for the skill and their new karma
+
+class EndorsementResult:
+    def __init__(self, skill, given, count, karma):
+        self.skill = skill
+        self.given = given
+        self.count = count
+        self.karma = karma
+
+
+# Gives or removes staff's endorsement of the student's skill. Returns an EndorsementResult
+
+def toggle_endorsement(staff, student, skill):
+    if skill not in SKILLS:
+        raise ValueError(f'Invalid skill {skill!r}')
+
+    with transaction.atomic():
+        endorsement = Endorsement.objects.select_for_update().filter(student=student, staff=staff).first()
+        if endorsement is None:
+            try:
+                with transaction.atomic():
+                    endorsement = Endorsement.objects.create(student=student, staff=staff)
+            except IntegrityError:
+                # a concurrent click created it first, apply this one on top of it
+                endorsement = Endorsement.objects.select_for_update().get(student=student, staff=staff)
+        given = not getattr(endorsement, skill)
+        Endorsement.objects.filter(pk=endorsement.pk).update(**{skill: given})
+        EndorsementStats.record_endorsement(student, skill, given)
+        Karma.apply_delta(student, Karma.endorsement_delta(given))
+        count = EndorsementStats.objects.filter(student=student).values_list(skill, flat=True).first()
+        karma = Karma.objects.filter(student=student).values_list('score', flat=True).first()
+
+    return EndorsementResult(skill, given, count, karma)
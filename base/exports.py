@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils import timezone
+from datetime import timedelta
+from itertools import takewhile
+from .models import School, Student, LeaderboardExport, SKILLS
+from .pdf import html_to_pdf
+from . import tasks
+import csv
+import json
+
+
+# renders a template to PDF, returns the PDF as bytes (or None if xhtml2pdf reported an error)
+# in_process renders the PDF in the background process pool (see tasks.run_in_process)
+
+def render_pdf(template_src, context_dict, in_process=False):
+    template = get_template(template_src)
+    html  = template.render(context_dict)
+    if in_process:
+        return tasks.run_in_process(html_to_pdf, html)
+    return html_to_pdf(html)
+
+
+
+# Returns the export of the school's current leaderboard (only the top students if top is given).
+# The PDF is rendered by the background worker the first time it is requested for the current
+# karma version, later requests reuse it until a karma score in the school changes.
+# If the web process dies before the export is rendered, python manage.py run_jobs renders it
+
+def request_leaderboard_export(school, top=0):
+    version = School.objects.filter(pk=school.pk).values_list('karma_version', flat=True).get()
+    export, created = LeaderboardExport.objects.get_or_create(school=school, karma_version=version, top=top)
+    if created:
+        delete_stale_exports(school, version)
+        tasks.enqueue(render_leaderboard_export, export.pk)
+    elif export.status == "FAILED":
+        LeaderboardExport.objects.filter(pk=export.pk).update(status="PENDING")
+        export.status = "PENDING"
+        tasks.enqueue(render_leaderboard_export, export.pk)
+    return export
+
+
+
+# Exports of older karma versions are stale, but they are only deleted once they have finished and
+# had settings.LEADERBOARD_EXPORT_RETENTION seconds to be downloaded, so a user who is waiting for
+# one (or about to download it) doesn't lose it because someone voted in the meantime
+
+def delete_stale_exports(school, version):
+    finished_before = timezone.now() - timedelta(seconds=settings.LEADERBOARD_EXPORT_RETENTION)
+    LeaderboardExport.objects.filter(
+        school=school, karma_version__lt=version, status__in=("DONE", "FAILED"), finished_at__lt=finished_before
+    ).delete()
+
+
+
+# background task: renders the leaderboard PDF for an export, unless another process already has
+
+def render_leaderboard_export(export_id):
+    if not tasks.claim_job(LeaderboardExport, export_id):
+        return
+    export = LeaderboardExport.objects.select_related('school').get(pk=export_id)
+    pdf = None
+    status = "FAILED"
+    try:
+        students = Student.leaderboard_snapshot(export.school)
+        school_total = len(students)
+        if export.top:
+            students = list(takewhile(lambda student: student.rank <= export.top, students))
+        context = {
+            'students' : students,
+            'school_total' : school_total,
+            'query' : export.top,
+            'school' : export.school.name
+        }
+        pdf = render_pdf('download-leaderboard.html', context, in_process=True)
+        status = "FAILED" if pdf is None else "DONE"
+    finally:
+        # an update rather than save(), which raises if the row was deleted while it was rendered
+        LeaderboardExport.objects.filter(pk=export.pk).update(pdf=pdf, status=status, finished_at=timezone.now())
+
+
+
+# Machine-readable leaderboard exports, streamed row by row so memory stays flat for any school size
+
+LEADERBOARD_COLUMNS = ('rank', 'name', 'karma') + SKILLS
+
+
+# yields one dict per student (rank, name, karma and per-skill endorsements), reading the
+# leaderboard from the database in chunks
+
+def leaderboard_rows(school, top=None, chunk_size=2000):
+    rows = Student.leaderboard(school, top=top).values_list(
+        'rank', 'name', 'karma__score', *[f'endorsementstats__{skill}' for skill in SKILLS]
+    )
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield dict(zip(LEADERBOARD_COLUMNS, row))
+
+
+# file-like object for csv.writer that hands back each line instead of storing it
+class Echo:
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(LEADERBOARD_COLUMNS)
+    for row in rows:
+        yield writer.writerow([row[column] for column in LEADERBOARD_COLUMNS])
+
+
+def stream_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
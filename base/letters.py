@@ -0,0 +1,143 @@
+from django.conf import settings
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from .models import Karma, EndorsementStats, SKILLS
+from .summaries import PendingSummary, generate_letter, request_summary_refresh
+from .llm import LLMUnavailable, request_deadline
+from .singleflight import SingleFlightTimeout
+from .prompts import truncate_to_tokens
+from .metrics import metrics
+import asyncio
+import random
+
+
+# Recommendation letters
+# The letter is written by the LLM backend from a summary of the student's best positive reviews.
+# A stored summary is reused when there is one (a stale one is refreshed in the background), otherwise
+# the summary is generated while the rest of the letter details are read from the database.
+# Template letters, to be completed by the teacher, are used when the backend is unavailable.
+# Letters are written while the teacher waits, so the summary and the letter share one deadline
+# (settings.LLM_REQUEST_DEADLINE) and failed calls are not retried
+
+
+# rank, qualities and keywords used to write a student's letter (reads the database)
+
+def letter_details(staff, student):
+    max_score = Karma.objects.filter(school=staff.school).order_by('-score').values_list('score', flat=True).first() # highest karma score in the school
+    rank = student.karma.score/max_score
+
+    highest_endorsements = EndorsementStats.school_highest(staff.school)
+    endorsement_stats = student.endorsementstats
+    # record qualities if the are at least half of the highest in the school
+    qualities = [skill for skill in SKILLS if getattr(endorsement_stats, skill) >= 0.5*highest_endorsements[skill]]
+
+    q = ""
+    if len(qualities)==0:
+        q = "[qualities/traits/skills]"
+    else:
+        for quality in qualities[:-1]:
+            q += quality +", "
+        q += "and " + qualities[-1]
+
+    if rank>=0.5:   # Excellent
+        keywords = ["excellent", "exemplary", "outstanding", "remarkable", "model"]
+    else:   # rank<0.5, fair/good
+        keywords = ["decent", "suitable", "average", "standard", "passable", "adequate", "moderate"]
+    # the keywords are picked with a fixed seed, so repeated requests produce the same prompt
+    keywords = random.Random(f'{staff.pk}:{student.pk}').sample(keywords, 3)
+
+    return {
+        'rank' : rank,
+        'qualities' : q,
+        'keywords' : keywords,
+        'staff_name' : staff.user.get_full_name(),
+        'school' : str(staff.school)
+    }
+
+
+def letter_prompt(student, summary, details):
+    if summary:
+        summary = truncate_to_tokens(summary, settings.LLM_INPUT_TOKEN_BUDGET)
+        return f"Based on {summary}, write a recommendation letter from {details['staff_name']} for a student named {student.name} who attended {details['school']} using words like {details['keywords']}"
+    return f"Write a recommendation letter from {details['staff_name']} for a student named {student.name} who attended {details['school']} using words like {details['keywords']}"
+
+
+# template letters are used when the OPENAI servers are busy. They will require manual completion by teachers in some parts
+
+def template_letter(student, details):
+    student_name = student.name
+    q = details['qualities']
+    school = details['school']
+    staff_name = details['staff_name']
+    if details['rank']>=0.5:
+        return f"Dear [Recipient's Name],\n\nI am writing to recommend {student_name} for [Purpose of Recommendation] for which he/she has applied. I have had the pleasure of [teaching/supervising/working with] {student_name} for [length of time] at {school}.\n\n During this time, I have had the opportunity to observe {student_name}'s exceptional {q}, which make him/her an outstanding candidate for [Purpose of Recommendation]. Specifically, [provide specific examples of the student's accomplishments or characteristics that demonstrate their suitability for the program or opportunity].\n\nIn addition to {student_name}'s exceptional {q}, he/she also possesses [other relevant qualities or characteristics, such as strong work ethic, leadership ability, creativity, or interpersonal skills]. These attributes have been critical to his/her success and have helped [him/her] to stand out as an exceptional student. Overall, I believe that {student_name} would be an excellent candidate for [Purpose of Recommendation], and I wholeheartedly endorse his/her application.\n\nIf you have any further questions or require additional information, please do not hesitate to contact me.\n\n Sincerely,\n{staff_name}"
+    return f"Dear [Recipient's Name],\n\nI am writing to recommend {student_name} for [Purpose of Recommendation] for which he/she has applied. I have had the pleasure of [teaching/supervising/working with] {student_name} for [length of time] at {school}.\n\n During this time, I have had the opportunity to observe {student_name}'s good {q}, which make him/her a fair candidate for [Purpose of Recommendation]. Specifically, [provide specific examples of the student's accomplishments or characteristics that demonstrate their suitability for the program or opportunity].\n\nIn addition to {student_name}'s good {q}, he/she also possesses [other relevant qualities or characteristics, such as strong work ethic, leadership ability, creativity, or interpersonal skills]. These attributes have been instrumental in his/her success and have helped identify [him/her] as a good student. Overall, I believe that {student_name} would be a suitable candidate for [Purpose of Recommendation], and I endorse his/her application.\n\nIf you have any further questions or require additional information, please do not hesitate to contact me.\n\n Sincerely,\n{staff_name}"
+
+
+
+# summary text to use straight away (None if it has to be generated, or there is none to generate)
+
+def usable_summary(pending):
+    if pending.needs_generation and pending.stored is not None:
+        request_summary_refresh(pending.student, pending.kind)  # use the last summary, refresh it in the background
+    if pending.digest is not None:
+        metrics.cache_lookup(pending.operation, hit=pending.stored is not None)
+    return pending.current_text or pending.stale_text
+
+
+def must_generate(pending):
+    return pending.needs_generation and pending.stored is None
+
+
+def finish_summary(pending, future):
+    try:
+        text = future.result()
+    except (LLMUnavailable, SingleFlightTimeout):
+        metrics.count(pending.operation, 'fallbacks')
+        return None
+    pending.save(text)
+    return text
+
+
+
+# Returns (letter text, whether a template letter was used instead of a generated one)
+
+def write_letter(staff, student):
+    deadline = request_deadline()
+    pending = PendingSummary(student, "LETTER")
+    summary = usable_summary(pending)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(pending.generate, deadline, 0) if must_generate(pending) else None
+        details = letter_details(staff, student)
+        if future:
+            summary = finish_summary(pending, future)
+
+    try:
+        return generate_letter(letter_prompt(student, summary, details), deadline, 0), False  # identical letter requests in flight share one completion
+    except (LLMUnavailable, SingleFlightTimeout): # switch to template if server is busy
+        metrics.count('letter', 'fallbacks')
+        return template_letter(student, details), True
+
+
+async def write_letter_async(staff, student):
+    deadline = request_deadline()
+    pending = await sync_to_async(PendingSummary)(student, "LETTER")
+    summary = await sync_to_async(usable_summary)(pending)
+    task = None
+    if must_generate(pending):
+        task = asyncio.ensure_future(sync_to_async(pending.generate, thread_sensitive=False)(deadline, 0))
+    details = await sync_to_async(letter_details)(staff, student)
+    if task:
+        try:
+            summary = await task
+        except (LLMUnavailable, SingleFlightTimeout):
+            metrics.count(pending.operation, 'fallbacks')
+            summary = None
+        else:
+            await sync_to_async(pending.save)(summary)
+
+    try:
+        return await sync_to_async(generate_letter, thread_sensitive=False)(letter_prompt(student, summary, details), deadline, 0), False
+    except (LLMUnavailable, SingleFlightTimeout):
+        metrics.count('letter', 'fallbacks')
+        return template_letter(student, details), True
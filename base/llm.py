@@ -0,0 +1,233 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import functools
+import hashlib
+import logging
+import random
+import threading
+import time
+import openai
+from .metrics import metrics
+from .prompts import estimate_tokens
+
+
+# Text generation backends used for student summaries and recommendation letters
+# settings.LLM_BACKEND picks the backend:
+#   'openai' - OpenAI completions (settings.OPENAI_API_KEY, settings.OPENAI_MODEL)
+#   'stub'   - local stand-in with configurable latency and failure rate and deterministic output,
+#              for running the profile and recommendation paths offline (eg. load tests)
+# Calls go through complete(), which adds a timeout, retries and a circuit breaker
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMTimeout(LLMError):
+    pass
+
+
+# raised by complete() when no text could be generated, callers fall back to cached or template text
+# outcome is 'timeout', 'error' or 'unavailable' (the circuit breaker is open)
+class LLMUnavailable(LLMError):
+    def __init__(self, message, outcome='error'):
+        super().__init__(message, retryable=False)
+        self.outcome = outcome
+
+
+# errors worth retrying: the provider is slow, overloaded or unreachable
+RETRYABLE_OPENAI_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class OpenAIBackend:
+    def __init__(self, api_key, model):
+        self.api_key = api_key
+        self.model = model
+
+    def complete(self, prompt, max_tokens=1000, timeout=None):
+        try:
+            response = openai.Completion.create(
+                api_key = self.api_key,
+                model = self.model,
+                prompt = prompt,
+                max_tokens = max_tokens,
+                temperature = 0,
+                request_timeout = timeout
+            )
+        except openai.error.Timeout as e:
+            raise LLMTimeout(str(e)) from e
+        except RETRYABLE_OPENAI_ERRORS as e:
+            raise LLMError(str(e)) from e
+        except openai.error.OpenAIError as e:   # eg. invalid key or request, retrying won't help
+            raise LLMError(str(e), retryable=False) from e
+        text = None
+        for result in response.choices:
+            text = result.text    # to get and keep the last value in the {}
+        if text is None:
+            raise LLMError('OpenAI returned no completion')
+        return text
+
+
+class StubBackend:
+    def __init__(self, latency=0, failure_rate=0, seed=0):
+        self.latency = latency  # seconds per call
+        self.failure_rate = failure_rate  # fraction of calls that raise LLMError
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def complete(self, prompt, max_tokens=1000, timeout=None):
+        if timeout is not None and self.latency > timeout:
+            time.sleep(timeout)
+            raise LLMTimeout('Stub backend timed out')
+        time.sleep(self.latency)
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+        if failed:
+            raise LLMError('Stub backend failure')
+        # the same prompt always gets the same text
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return f'Generated text {digest[:12]} for a prompt of {len(prompt)} characters.'
+
+
+
+# Circuit breaker: after `threshold` consecutive failed calls the circuit opens and calls fail fast
+# for `reset_timeout` seconds, then one trial call is let through (half open) - if it succeeds the
+# circuit closes again, otherwise it stays open for another reset_timeout
+
+class CircuitBreaker:
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+# backend configured in settings, created once per configuration
+
+def get_backend():
+    if settings.LLM_BACKEND == 'stub':
+        return create_backend('stub', settings.LLM_STUB_LATENCY, settings.LLM_STUB_FAILURE_RATE)
+    if settings.LLM_BACKEND == 'openai':
+        return create_backend('openai', settings.OPENAI_API_KEY, settings.OPENAI_MODEL)
+    raise ImproperlyConfigured(f'Unknown LLM_BACKEND {settings.LLM_BACKEND!r}')
+
+
+@functools.lru_cache(maxsize=None)
+def create_backend(name, *options):
+    if name == 'stub':
+        return StubBackend(*options)
+    return OpenAIBackend(*options)
+
+
+def get_breaker():
+    return create_breaker(settings.LLM_BREAKER_THRESHOLD, settings.LLM_BREAKER_RESET_TIMEOUT)
+
+
+@functools.lru_cache(maxsize=None)
+def create_breaker(threshold, reset_timeout):
+    return CircuitBreaker(threshold, reset_timeout)
+
+
+
+# Generates text for the prompt with the configured backend. The call gives up at `deadline`
+# (time.monotonic(), settings.LLM_DEADLINE seconds from now by default): each attempt is limited to
+# settings.LLM_TIMEOUT seconds or the time left, whichever is less, and failed attempts are retried
+# up to `retries` times (settings.LLM_RETRIES by default) with exponential backoff while there is
+# time left. While the circuit breaker is open no call is made at all.
+# Every call is recorded in the metrics under `operation`. Raises LLMUnavailable if no text could be generated
+
+def complete(prompt, max_tokens=1000, operation='completion', deadline=None, retries=None):
+    start = time.monotonic()
+    deadline = start + settings.LLM_DEADLINE if deadline is None else deadline
+    retries = settings.LLM_RETRIES if retries is None else retries
+    attempts = 0
+    text = None
+    outcome = 'error'
+    try:
+        breaker = get_breaker()
+        backend = get_backend()
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                # if the circuit opened during our own retries, the outcome is that of the last attempt
+                raise LLMUnavailable('Text generation is unavailable, the circuit breaker is open', outcome=outcome if attempts else 'unavailable')
+            timeout = min(settings.LLM_TIMEOUT, time_left(deadline))
+            if timeout <= 0:
+                raise LLMUnavailable('Text generation ran out of time', outcome='timeout')
+            attempts += 1
+            try:
+                text = backend.complete(prompt, max_tokens=max_tokens, timeout=timeout)
+            except LLMError as e:
+                logger.warning('Text generation failed (attempt %s): %s', attempts, e)
+                outcome = 'timeout' if isinstance(e, LLMTimeout) else 'error'
+                if not e.retryable:
+                    breaker.record_success()  # the provider answered, the request itself was rejected
+                    raise LLMUnavailable(str(e), outcome=outcome) from e
+                breaker.record_failure()
+                delay = settings.LLM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                if attempt == retries or delay >= time_left(deadline):
+                    raise LLMUnavailable(str(e), outcome=outcome) from e
+                time.sleep(delay)
+            except Exception as e:
+                # an unexpected error still ends the half open trial, or the circuit would never close again
+                logger.exception('Text generation failed (attempt %s)', attempts)
+                breaker.record_failure()
+                raise LLMUnavailable(str(e), outcome='error') from e
+            else:
+                breaker.record_success()
+                outcome = 'success'
+                return text
+    except LLMUnavailable as e:
+        outcome = e.outcome
+        raise
+    finally:
+        output_tokens = estimate_tokens(text) if text else 0
+        metrics.record_call(operation, outcome, time.monotonic() - start, estimate_tokens(prompt), output_tokens, attempts)
+
+
+def time_left(deadline):
+    return max(0, deadline - time.monotonic())
+
+
+# deadline shared by all the text generation of a web request, see settings.LLM_REQUEST_DEADLINE
+
+def request_deadline():
+    return time.monotonic() + settings.LLM_REQUEST_DEADLINE
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from base.models import Student
+
+
+# Lists the students that share a name with another student of their school, which migration 0015
+# doesn't allow. With --rename, every student after the first is renamed "<name> (2)", "<name> (3)", ...
+# (this changes their profile URL, reviews, votes and endorsements are kept)
+# usage: python manage.py duplicate_students [--rename]
+
+class Command(BaseCommand):
+    help = 'List students with the same name in a school, and optionally rename all but the first of them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rename', action='store_true', help='Rename the duplicates so that names are unique within each school')
+
+    def handle(self, *args, **options):
+        max_length = Student._meta.get_field('name').max_length
+        duplicates = Student.objects.values('school_id', 'name').annotate(num_students=Count('id')).filter(num_students__gt=1)
+        if not duplicates:
+            self.stdout.write(self.style.SUCCESS('No duplicate students.'))
+            return
+
+        with transaction.atomic():
+            for duplicate in duplicates:
+                ids = list(Student.objects.filter(school_id=duplicate['school_id'], name=duplicate['name']).order_by('id').values_list('id', flat=True))
+                self.stdout.write(f"{duplicate['name']!r} in school {duplicate['school_id']}: students {', '.join(map(str, ids))}")
+                if not options['rename']:
+                    continue
+                number = 2
+                for student_id in ids[1:]:
+                    while True:
+                        suffix = f' ({number})'
+                        name = duplicate['name'][:max_length - len(suffix)] + suffix
+                        number += 1
+                        if not Student.objects.filter(school_id=duplicate['school_id'], name=name).exists():
+                            break
+                    Student.objects.filter(pk=student_id).update(name=name)
+                    self.stdout.write(f'  renamed student {student_id} to {name!r}')
+
+        action = 'Renamed' if options['rename'] else 'Found'
+        self.stdout.write(self.style.WARNING(f'{action} duplicates of {len(duplicates)} name(s).'))
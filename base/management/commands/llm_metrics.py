@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from django.utils import timezone
+from datetime import timedelta
+from base.models import LLMCall
+from base.metrics import latency_summary, OUTCOMES
+
+
+# Prints latency percentiles, token counts and outcomes of the saved text generation calls
+# usage: python manage.py llm_metrics [--hours 24]
+
+class Command(BaseCommand):
+    help = 'Print latency percentiles, token counts and outcomes of the text generation calls made in the last hours'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help='Only report on calls made in the last HOURS hours (default 24)')
+
+    def handle(self, *args, **options):
+        calls = LLMCall.objects.filter(created_at__gte=timezone.now() - timedelta(hours=options['hours']))
+        operations = calls.values('operation').annotate(
+            num_calls=Count('id'),
+            input_tokens=Sum('input_tokens'),
+            output_tokens=Sum('output_tokens')
+        ).order_by('operation')
+
+        if not operations:
+            self.stdout.write(f'No calls in the last {options["hours"]:g} hours.')
+            return
+
+        for operation in operations:
+            name = operation['operation']
+            latencies = list(calls.filter(operation=name).values_list('latency', flat=True))
+            outcomes = dict(calls.filter(operation=name).values_list('outcome').annotate(Count('id')))
+            summary = latency_summary(latencies)
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name}: {operation["num_calls"]} call(s)'))
+            self.stdout.write('  latency  ' + '  '.join(f'{key} {value * 1000:.0f}ms' for key, value in summary.items()))
+            self.stdout.write('  outcomes ' + '  '.join(f'{outcome} {outcomes.get(outcome, 0)}' for outcome in OUTCOMES))
+            self.stdout.write(f'  tokens   input {operation["input_tokens"]}  output {operation["output_tokens"]}')
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from base.models import LeaderboardExport, ImportJob
+from base.exports import render_leaderboard_export
+from base.roster import run_import_job, upload_available
+from base import tasks
+import time
+
+
+# Runs the saved jobs that are pending, or were abandoned by a web process that was recycled,
+# killed or redeployed while running them (see base/tasks.py)
+# usage: python manage.py run_jobs [--once] [--interval 5]
+
+# (model, task, whether this process can run the job or None)
+JOBS = (
+    (LeaderboardExport, render_leaderboard_export, None),
+    (ImportJob, run_import_job, upload_available),
+)
+
+
+class Command(BaseCommand):
+    help = 'Run pending and abandoned background jobs (leaderboard exports, roster imports), polling the database for new ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the jobs found and exit instead of polling')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between polls when there is nothing to run (default 5)')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            ran = self.run_jobs()
+            if options['once']:
+                self.stdout.write(f'Ran {ran} job(s).')
+                return
+            if not ran:
+                time.sleep(options['interval'])
+
+    def run_jobs(self):
+        ran = 0
+        for model, func, can_run in JOBS:
+            for pk in list(tasks.runnable_jobs(model).order_by('created_at').values_list('pk', flat=True)):
+                if can_run and not can_run(pk):
+                    continue
+                tasks.run(func, pk)  # the job claims its row, so jobs picked up by a web process are skipped
+                ran += 1
+        return ran
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from base.models import Karma, Stats, EndorsementStats, SKILLS
+
+
+# Verifies the incrementally maintained counters against a full recomputation
+# usage: python manage.py verify_counters [--fix]
+
+class Command(BaseCommand):
+    help = 'Verify karma scores, review vote counters and endorsement counters against a full recomputation, and optionally repair them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Save the recomputed value for every mismatch found')
+
+    def handle(self, *args, **options):
+        mismatches = self.verify_votes(options['fix'])
+        mismatches += self.verify_endorsements(options['fix'])
+        mismatches += self.verify_karma(options['fix'])
+
+        if mismatches:
+            action = 'Repaired' if options['fix'] else 'Found'
+            self.stdout.write(self.style.WARNING(f'{action} {mismatches} mismatched counter(s).'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All counters are consistent.'))
+
+    def verify_karma(self, fix):
+        mismatches = 0
+        for karma in Karma.objects.select_related('student'):
+            expected = karma.calculate_score()
+            if karma.score != expected:
+                mismatches += 1
+                self.stdout.write(f'Karma for {karma.student.name}: stored {karma.score}, expected {expected}')
+                if fix:
+                    karma.score = expected
+                    karma.save(update_fields=['score'])
+        return mismatches
+
+    def verify_votes(self, fix):
+        mismatches = 0
+        stats_list = Stats.objects.annotate(
+            num_upvotes=Count('review__vote', filter=Q(review__vote__value='UP')),
+            num_downvotes=Count('review__vote', filter=Q(review__vote__value='DOWN'))
+        ).exclude(upvotes=F('num_upvotes'), downvotes=F('num_downvotes'))
+        for stats in stats_list:
+            mismatches += 1
+            self.stdout.write(f'Votes for review {stats.pk}: stored {stats.upvotes}/{stats.downvotes}, expected {stats.num_upvotes}/{stats.num_downvotes}')
+            if fix:
+                Stats.objects.filter(pk=stats.pk).update(upvotes=stats.num_upvotes, downvotes=stats.num_downvotes)
+        return mismatches
+
+    def verify_endorsements(self, fix):
+        mismatches = 0
+        repaired_schools = set()
+        stats_list = EndorsementStats.objects.select_related('student').annotate(**{
+            f'num_{skill}': Count('student__endorsement', filter=Q(**{f'student__endorsement__{skill}': True}))
+            for skill in SKILLS
+        })
+        for stats in stats_list:
+            stored = {skill: getattr(stats, skill) for skill in SKILLS}
+            expected = {skill: getattr(stats, f'num_{skill}') for skill in SKILLS}
+            if stored != expected:
+                mismatches += 1
+                self.stdout.write(f'Endorsements for {stats.student.name}: stored {stored}, expected {expected}')
+                if fix:
+                    EndorsementStats.objects.filter(pk=stats.pk).update(**expected)
+                    repaired_schools.add(stats.student.school_id)
+        # the cached school highest endorsements were computed from the wrong counters
+        cache.delete_many([EndorsementStats.school_highest_key(school_id) for school_id in repaired_schools])
+        return mismatches
@@ -0,0 +1,114 @@
+from django.core.signals import request_finished
+from django.db import DatabaseError
+from collections import Counter, defaultdict, deque
+import logging
+import threading
+
+
+# Instrumentation of text generation (see base/llm.py)
+# Every call is aggregated in memory (latency, token counts, outcome) for the metrics endpoint,
+# together with summary cache hits/misses and fallbacks to cached or template text. Calls are also
+# saved as LLMCall rows for the llm_metrics command. The rows are buffered and written at the end of
+# each request (or background task), so text generation itself never waits on the database
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES = ('success', 'timeout', 'error', 'unavailable')
+LATENCY_SAMPLES = 1000      # latest calls per operation kept for the in-process percentiles
+MAX_PENDING = 10000         # calls waiting to be saved, the oldest are dropped past this
+
+
+# nearest-rank percentile of a list of numbers
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(index)]
+
+
+def latency_summary(latencies):
+    return {
+        'p50' : percentile(latencies, 50),
+        'p90' : percentile(latencies, 90),
+        'p99' : percentile(latencies, 99),
+        'max' : max(latencies) if latencies else None
+    }
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+            self.counters = defaultdict(Counter)
+            self.pending = deque(maxlen=MAX_PENDING)
+
+    def record_call(self, operation, outcome, latency, input_tokens, output_tokens, attempts):
+        with self.lock:
+            self.latencies[operation].append(latency)
+            counters = self.counters[operation]
+            counters['calls'] += 1
+            counters[outcome] += 1
+            counters['input_tokens'] += input_tokens
+            counters['output_tokens'] += output_tokens
+            self.pending.append({
+                'operation' : operation,
+                'outcome' : outcome,
+                'latency' : latency,
+                'input_tokens' : input_tokens,
+                'output_tokens' : output_tokens,
+                'attempts' : attempts
+            })
+
+    def count(self, operation, name):
+        with self.lock:
+            self.counters[operation][name] += 1
+
+    def cache_lookup(self, operation, hit):
+        self.count(operation, 'cache_hits' if hit else 'cache_misses')
+
+    def snapshot(self):
+        with self.lock:
+            operations = set(self.counters) | set(self.latencies)
+            result = {}
+            for operation in sorted(operations):
+                counters = self.counters[operation]
+                lookups = counters['cache_hits'] + counters['cache_misses']
+                result[operation] = {
+                    'calls' : counters['calls'],
+                    'outcomes' : {outcome: counters[outcome] for outcome in OUTCOMES},
+                    'latency' : latency_summary(list(self.latencies[operation])),
+                    'input_tokens' : counters['input_tokens'],
+                    'output_tokens' : counters['output_tokens'],
+                    'fallbacks' : counters['fallbacks'],
+                    'cache_hits' : counters['cache_hits'],
+                    'cache_misses' : counters['cache_misses'],
+                    'cache_hit_rate' : counters['cache_hits'] / lookups if lookups else None
+                }
+            return result
+
+    def flush(self):
+        from .models import LLMCall
+        with self.lock:
+            records = list(self.pending)
+            self.pending.clear()
+        if not records:
+            return
+        try:
+            LLMCall.objects.bulk_create([LLMCall(**record) for record in records])
+        except DatabaseError:
+            logger.exception('Could not save %s LLM call record(s)', len(records))
+
+
+metrics = Metrics()
+
+
+def flush_metrics(**kwargs):
+    metrics.flush()
+
+request_finished.connect(flush_metrics, dispatch_uid='base.metrics.flush_metrics')
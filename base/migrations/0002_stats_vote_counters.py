@@ -0,0 +1,42 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:44
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+# fills the new upvotes/downvotes columns from the Vote table, creating any missing Stats rows
+
+def backfill_vote_counters(apps, schema_editor):
+    Review = apps.get_model('base', 'Review')
+    Stats = apps.get_model('base', 'Stats')
+
+    missing = Review.objects.filter(stats__isnull=True).values_list('id', flat=True)
+    Stats.objects.bulk_create([Stats(review_id=review_id) for review_id in missing], batch_size=1000)
+
+    counts = Stats.objects.annotate(
+        num_upvotes=Count('review__vote', filter=Q(review__vote__value='UP')),
+        num_downvotes=Count('review__vote', filter=Q(review__vote__value='DOWN')),
+    ).filter(Q(num_upvotes__gt=0) | Q(num_downvotes__gt=0))
+    for stats in counts.iterator(chunk_size=1000):
+        Stats.objects.filter(pk=stats.pk).update(upvotes=stats.num_upvotes, downvotes=stats.num_downvotes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stats',
+            name='downvotes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stats',
+            name='upvotes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_vote_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:46
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+SKILLS = ('leadership', 'respect', 'punctuality', 'participation', 'teamwork')
+
+
+# fills the new per-skill counters from the Endorsement table
+
+def backfill_endorsement_counters(apps, schema_editor):
+    EndorsementStats = apps.get_model('base', 'EndorsementStats')
+
+    counts = EndorsementStats.objects.annotate(**{
+        f'num_{skill}': Count('student__endorsement', filter=Q(**{f'student__endorsement__{skill}': True}))
+        for skill in SKILLS
+    })
+    for stats in counts.iterator(chunk_size=1000):
+        values = {skill: getattr(stats, f'num_{skill}') for skill in SKILLS}
+        if any(values.values()):
+            EndorsementStats.objects.filter(pk=stats.pk).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_stats_vote_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='endorsementstats',
+            name='leadership',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='endorsementstats',
+            name='participation',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='endorsementstats',
+            name='punctuality',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='endorsementstats',
+            name='respect',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='endorsementstats',
+            name='teamwork',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_endorsement_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery
+
+
+# copies each student's school onto their karma row
+
+def backfill_karma_school(apps, schema_editor):
+    Karma = apps.get_model('base', 'Karma')
+    Student = apps.get_model('base', 'Student')
+    school = Student.objects.filter(pk=OuterRef('student_id')).values('school_id')[:1]
+    Karma.objects.update(school_id=Subquery(school))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_endorsementstats_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='karma',
+            name='school',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.school'),
+        ),
+        migrations.RunPython(backfill_karma_school, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='karma',
+            index=models.Index(fields=['school', '-score'], name='karma_school_score_idx'),
+        ),
+    ]
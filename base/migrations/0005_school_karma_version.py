@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_karma_school_score_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='school',
+            name='karma_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
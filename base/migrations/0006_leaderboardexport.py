@@ -0,0 +1,30 @@
+# Generated by Django 4.1.6 on 2026-10-18 09:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_school_karma_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardExport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('karma_version', models.PositiveIntegerField()),
+                ('top', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=7)),
+                ('pdf', models.BinaryField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('school', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.school')),
+            ],
+            options={
+                'unique_together': {('school', 'karma_version', 'top')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('PROFILE', 'Profile'), ('LETTER', 'Letter')], max_length=7)),
+                ('input_hash', models.CharField(max_length=64)),
+                ('text', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.student')),
+            ],
+            options={
+                'unique_together': {('student', 'kind')},
+            },
+        ),
+    ]
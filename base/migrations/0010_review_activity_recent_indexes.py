@@ -0,0 +1,21 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_llmcall'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='activity_user_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['student', '-created_at', '-id'], name='review_student_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:38
+
+from django.db import migrations
+from django.db.models import Count, F, Max, Q
+
+
+# the karma rules when this migration was written (see base.models), so it keeps working if they change
+SKILLS = ('leadership', 'respect', 'punctuality', 'participation', 'teamwork')
+DEFAULT_KARMA = 100
+REVIEW_KARMA = 50
+VOTE_KARMA = 5
+ENDORSEMENT_KARMA = 10
+
+
+# keeps only the latest vote of each staff member on a review, and recounts the votes and the karma
+# of the reviews that had duplicates
+
+def remove_duplicate_votes(apps, schema_editor):
+    Vote = apps.get_model('base', 'Vote')
+    Stats = apps.get_model('base', 'Stats')
+    duplicates = Vote.objects.values('staff_id', 'review_id').annotate(num_votes=Count('id'), latest=Max('id')).filter(num_votes__gt=1)
+    review_ids = set()
+    for duplicate in duplicates:
+        Vote.objects.filter(staff_id=duplicate['staff_id'], review_id=duplicate['review_id']).exclude(id=duplicate['latest']).delete()
+        review_ids.add(duplicate['review_id'])
+    for stats in Stats.objects.filter(review_id__in=review_ids):
+        votes = Vote.objects.filter(review_id=stats.review_id).aggregate(
+            upvotes=Count('id', filter=Q(value='UP')),
+            downvotes=Count('id', filter=Q(value='DOWN'))
+        )
+        Stats.objects.filter(pk=stats.pk).update(**votes)
+    Review = apps.get_model('base', 'Review')
+    recompute_karma(apps, set(Review.objects.filter(id__in=review_ids).values_list('student_id', flat=True)))
+
+
+# same rules as Karma.calculate_score, with the historical models
+
+def recompute_karma(apps, student_ids):
+    Karma = apps.get_model('base', 'Karma')
+    Review = apps.get_model('base', 'Review')
+    Endorsement = apps.get_model('base', 'Endorsement')
+    School = apps.get_model('base', 'School')
+    for karma in Karma.objects.filter(student_id__in=student_ids):
+        score = DEFAULT_KARMA
+        reviews = Review.objects.filter(student_id=karma.student_id, deleted__isnull=True).annotate(
+            num_upvotes=Count('vote', filter=Q(vote__value='UP')),
+            num_downvotes=Count('vote', filter=Q(vote__value='DOWN'))
+        )
+        for review in reviews:
+            contribution = REVIEW_KARMA + (review.num_upvotes - review.num_downvotes) * VOTE_KARMA
+            score += contribution if review.is_good else -contribution
+        endorsements = Endorsement.objects.filter(student_id=karma.student_id)
+        score += sum(endorsements.filter(**{skill: True}).count() for skill in SKILLS) * ENDORSEMENT_KARMA
+        Karma.objects.filter(pk=karma.pk).update(score=score)
+    # cached leaderboards of these schools are stale
+    school_ids = Karma.objects.filter(student_id__in=student_ids).values('school_id')
+    School.objects.filter(pk__in=school_ids).update(karma_version=F('karma_version') + 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_review_activity_recent_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='vote',
+            unique_together={('staff', 'review')},
+        ),
+    ]
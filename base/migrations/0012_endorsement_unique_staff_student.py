@@ -0,0 +1,55 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:50
+
+from django.db import migrations
+from django.db.models import Count, Max, Q
+from importlib import import_module
+
+
+SKILLS = ('leadership', 'respect', 'punctuality', 'participation', 'teamwork')
+
+# karma is recomputed the way migration 0011 does it, with the karma rules of that time
+recompute_karma = import_module('base.migrations.0011_vote_unique_staff_review').recompute_karma
+
+
+# merges the duplicate endorsement rows of each staff member for a student into the latest one
+# (a skill stays endorsed if any of the rows endorsed it), then recounts the endorsement counters
+# and karma of the students that had duplicates
+
+def merge_duplicate_endorsements(apps, schema_editor):
+    Endorsement = apps.get_model('base', 'Endorsement')
+    duplicates = Endorsement.objects.values('staff_id', 'student_id').annotate(num_rows=Count('id'), latest=Max('id')).filter(num_rows__gt=1)
+    student_ids = set()
+    for duplicate in duplicates:
+        rows = Endorsement.objects.filter(staff_id=duplicate['staff_id'], student_id=duplicate['student_id'])
+        merged = {skill: rows.filter(**{skill: True}).exists() for skill in SKILLS}
+        rows.filter(id=duplicate['latest']).update(**merged)
+        rows.exclude(id=duplicate['latest']).delete()
+        student_ids.add(duplicate['student_id'])
+    if student_ids:
+        recount_endorsements(apps, student_ids)
+        recompute_karma(apps, student_ids)
+
+
+def recount_endorsements(apps, student_ids):
+    Endorsement = apps.get_model('base', 'Endorsement')
+    EndorsementStats = apps.get_model('base', 'EndorsementStats')
+    for student_id in student_ids:
+        counts = Endorsement.objects.filter(student_id=student_id).aggregate(**{
+            skill: Count('id', filter=Q(**{skill: True})) for skill in SKILLS
+        })
+        EndorsementStats.objects.filter(student_id=student_id).update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_vote_unique_staff_review'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_endorsements, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='endorsement',
+            unique_together={('staff', 'student')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0012_endorsement_unique_staff_student'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='leaderboardexport',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='leaderboardexport',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=7),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0013_leaderboardexport_started_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
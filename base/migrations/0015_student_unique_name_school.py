@@ -0,0 +1,34 @@
+# Generated by Django 4.1.6 on 2026-10-18 11:40
+
+from django.db import migrations
+from django.db.models import Count
+
+
+# Students are looked up by name within their school, so the name has to be unique there. Existing
+# duplicates are not changed here (renaming a student changes their profile URL): the migration stops
+# and lists them, to be merged by hand or renamed with python manage.py duplicate_students --rename
+
+def check_duplicate_students(apps, schema_editor):
+    Student = apps.get_model('base', 'Student')
+    duplicates = Student.objects.values('school_id', 'name').annotate(num_students=Count('id')).filter(num_students__gt=1)
+    if duplicates:
+        listed = ', '.join(f"{duplicate['name']!r} (school {duplicate['school_id']}, {duplicate['num_students']} students)" for duplicate in duplicates)
+        raise RuntimeError(
+            f'Student names must be unique within a school, found duplicates: {listed}. '
+            'Merge them, or rename them with python manage.py duplicate_students --rename, then migrate again.'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0014_importjob_started_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_students, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='student',
+            unique_together={('name', 'school')},
+        ),
+    ]
@@ -1,9 +1,14 @@
-from django.db import models
+from django.db import models, transaction
+from django.conf import settings
+from django.db.models import F, Max, Subquery, Window
+from django.db.models.functions import Coalesce, Rank
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.core.validators import MinLengthValidator
 from django.utils import timezone
 # from zoneinfo import ZoneInfo
 from datetime import datetime
+from collections import namedtuple
 from safedelete.models import SafeDeleteModel, SOFT_DELETE_CASCADE
 
 
@@ -12,10 +17,17 @@ from safedelete.models import SafeDeleteModel, SOFT_DELETE_CASCADE
 
 class School (models.Model):
     name = models.CharField(max_length=200, null=False, unique=True)
+    karma_version = models.PositiveIntegerField(default=0, editable=False) # bumped whenever the school's leaderboard may have changed
 
     def __str__(self):
         return '%s' % (self.name)
 
+    # bumped once the current transaction commits, so karma writes don't all wait on the school's row
+    # lock until their transactions end (the new version is only needed once the change is visible)
+    @staticmethod
+    def bump_karma_version(school_id):
+        transaction.on_commit(lambda: School.objects.filter(pk=school_id).update(karma_version=F('karma_version') + 1))
+
 
 
 # Admin Model
@@ -56,6 +68,40 @@ class Student (models.Model):
     def __str__(self):
         return '%s : %s' % (self.name, self.school.name)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        School.bump_karma_version(self.school_id)
+
+    # students of the school ordered by karma and annotated with their rank, which is computed
+    # by the database (students with the same karma score share a rank, eg. 1, 1, 3)
+    # if top is given, only the students ranked top or better are included
+    @staticmethod
+    def leaderboard(school, top=None):
+        students = Student.objects.filter(school=school)
+        if top:
+            # a student is ranked top or better exactly when their score is at least the top-th highest score
+            threshold = Karma.objects.filter(school=school).order_by('-score').values_list('score', flat=True)[top-1:top]
+            students = students.filter(karma__score__gte=Subquery(threshold))
+        return students.select_related('karma').annotate(
+            rank=Window(expression=Rank(), order_by=F('karma__score').desc())
+        ).order_by('-karma__score', 'name')
+
+    # the school's leaderboard as a list of LeaderboardEntry, read from a snapshot that is cached
+    # under the school's karma version, so only the first request after a karma change ranks the school
+    @staticmethod
+    def leaderboard_snapshot(school):
+        version = School.objects.filter(pk=school.pk).values_list('karma_version', flat=True).get()
+        key = f'leaderboard:{school.pk}:{version}'
+        snapshot = cache.get(key)
+        if snapshot is None:
+            rows = Student.leaderboard(school).values_list('id', 'name', 'karma__score', 'rank')
+            snapshot = [LeaderboardEntry(*row) for row in rows]
+            cache.set(key, snapshot, settings.LEADERBOARD_CACHE_TIMEOUT)
+        return snapshot
+
+
+LeaderboardEntry = namedtuple('LeaderboardEntry', ['id', 'name', 'score', 'rank'])
+
 
 
 # Review Model
@@ -73,6 +119,11 @@ class Review(SafeDeleteModel):
     created_at= models.DateTimeField(auto_now_add=True)
     edited= models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['student', '-created_at', '-id'], name='review_student_recent_idx'),
+        ]
+
     def __str__(self):
         return '%s staff: %s student: %s text: %s rating: %d' % (timezone.localtime(self.created_at).strftime("%d/%m/%Y, %H:%M"), self.staff.user.get_full_name(), self.student.name, self.text, self.rating)
 
@@ -80,10 +131,21 @@ class Review(SafeDeleteModel):
     def timestamp(self):
         return '%s' % (timezone.localtime(self.created_at).strftime("%b %-d, %Y"))
 
+    @property
+    def net_votes(self):
+        return self.stats.upvotes - self.stats.downvotes
+
+    # annotates the reviews with their net votes as `helpfulness`, so they can be ordered by it in the database
+    @staticmethod
+    def annotate_helpfulness(reviews):
+        return reviews.annotate(helpfulness=Coalesce('stats__upvotes', 0) - Coalesce('stats__downvotes', 0))
+
 
 
 # Endorsement Model
 
+SKILLS = ('leadership', 'respect', 'punctuality', 'participation', 'teamwork')
+
 class Endorsement (models.Model):   #change to boolean
     leadership= models.BooleanField(default=False)
     respect= models.BooleanField(default=False)
@@ -93,39 +155,55 @@ class Endorsement (models.Model):   #change to boolean
     student= models.ForeignKey(Student, on_delete=models.CASCADE)
     staff= models.ForeignKey(Staff, on_delete=models.CASCADE)
 
+    class Meta:
+        unique_together = ('staff', 'student',)
+
     def __str__(self):
         return 'staff: %s leadership: %s respect: %s punctuality: %s participation: %s teamwork: %s' % (self.staff.user.get_full_name(), self.leadership, self.respect, self.punctuality, self.participation, self.teamwork)
 
 
 
 # Endorsement Stats Model
+# the per-skill counters are maintained by give_endorsement (see EndorsementStats.record_endorsement)
+# run the verify_counters management command to check them against the Endorsement table
 
 class EndorsementStats (models.Model):
     student = models.OneToOneField(Student, on_delete=models.CASCADE, primary_key=True)
+    leadership = models.PositiveIntegerField(default=0, db_index=True)
+    respect = models.PositiveIntegerField(default=0, db_index=True)
+    punctuality = models.PositiveIntegerField(default=0, db_index=True)
+    participation = models.PositiveIntegerField(default=0, db_index=True)
+    teamwork = models.PositiveIntegerField(default=0, db_index=True)
 
     @property
     def school(self):
         return self.student.school
 
-    @property
-    def leadership(self):
-        return Endorsement.objects.filter(student=self.student, leadership=True).count()
-
-    @property
-    def respect(self):
-        return Endorsement.objects.filter(student=self.student, respect=True).count()
-
-    @property
-    def punctuality(self):
-        return Endorsement.objects.filter(student=self.student, punctuality=True).count()
-
-    @property
-    def participation(self):
-        return Endorsement.objects.filter(student=self.student, participation=True).count()
-
-    @property
-    def teamwork(self):
-        return Endorsement.objects.filter(student=self.student, teamwork=True).count()
+    # atomically adds (given=True) or removes (given=False) one endorsement for the skill
+    @staticmethod
+    def record_endorsement(student, skill, given):
+        if skill in SKILLS:
+            delta = 1 if given else -1
+            EndorsementStats.objects.filter(student=student).update(**{skill: F(skill) + delta})
+            # dropped once the change is committed, so no other request can cache the old highest in between
+            key = EndorsementStats.school_highest_key(student.school_id)
+            transaction.on_commit(lambda: cache.delete(key))
+
+    @staticmethod
+    def school_highest_key(school_id):
+        return f'school-highest-endorsements:{school_id}'
+
+    # the school highest for each skill, eg. {'leadership': 4, 'respect': 2, ...}
+    # computed with a single grouped query and cached until an endorsement in the school changes
+    @staticmethod
+    def school_highest(school):
+        key = EndorsementStats.school_highest_key(school.pk)
+        highest = cache.get(key)
+        if highest is None:
+            totals = EndorsementStats.objects.filter(student__school=school).aggregate(**{skill: Max(skill) for skill in SKILLS})
+            highest = {skill: totals[skill] or 0 for skill in SKILLS}
+            cache.set(key, highest, settings.HIGHEST_ENDORSEMENTS_CACHE_TIMEOUT)
+        return highest
 
 
 
@@ -142,36 +220,102 @@ class Vote (models.Model):
     time= models.DateTimeField(auto_now_add=True)
     value= models.CharField(choices=VOTE_TYPE, max_length=4)
 
+    class Meta:
+        unique_together = ('staff', 'review',)
+
     def __str__(self):
         return 'staff: %s review: %s value: %s' % (self.staff, self.review, self.value)
 
+    # the staff member's votes on the given reviews (or review ids) in one query: {review id: "UP" or "DOWN"}
+    # reviews they haven't voted on are left out
+    @staticmethod
+    def values_for(staff, reviews):
+        review_ids = [getattr(review, 'pk', review) for review in reviews]
+        return dict(Vote.objects.filter(staff=staff, review_id__in=review_ids).values_list('review_id', 'value'))
+
 
 
 # Karma
+# karma is kept up to date by applying deltas (see Karma.apply_delta) whenever a review, vote
+# or endorsement changes. update_score() does the full recomputation and is only used to verify
+# or repair scores (eg. by the verify_counters management command)
+
+DEFAULT_KARMA = 100
+REVIEW_KARMA = 50       # for each good review, subtracted for each bad review
+VOTE_KARMA = 5          # for each upvote on a good review / downvote on a bad review, and vice versa
+ENDORSEMENT_KARMA = 10  # for each skill endorsement
 
 class Karma (models.Model):
     student= models.OneToOneField(Student, on_delete=models.CASCADE, primary_key=True)
-    score = models.IntegerField(default=100)
+    score = models.IntegerField(default=DEFAULT_KARMA)
+    school= models.ForeignKey(School, on_delete=models.CASCADE, null=True, editable=False) # copy of student.school, for ranking queries
 
-    def update_score(self):
-        karma=100 #default karma score is 100
+    class Meta:
+        indexes = [
+            models.Index(fields=['school', '-score'], name='karma_school_score_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None:
+            self.school_id = self.student.school_id
+        super().save(*args, **kwargs)
+        School.bump_karma_version(self.school_id)
+
+    # where the student stands in their school, using indexed counts instead of the full leaderboard
+    # percentile is the percentage of the school ranked at or below the student
+    def standing(self):
+        total = Karma.objects.filter(school_id=self.school_id).count()
+        rank = Karma.objects.filter(school_id=self.school_id, score__gt=self.score).count() + 1
+        return {
+            'rank' : rank,
+            'total' : total,
+            'percentile' : round(100 * (total - rank + 1) / total) if total else 100
+        }
+
+    # karma a single review contributes, given its net votes (upvotes - downvotes)
+    @staticmethod
+    def review_delta(is_good, net_votes=0):
+        contribution = REVIEW_KARMA + (net_votes*VOTE_KARMA)
+        return contribution if is_good else -contribution
+
+    # karma change when a vote on a review goes from old_value to new_value ("UP", "DOWN" or None)
+    @staticmethod
+    def vote_delta(is_good, old_value, new_value):
+        values = {"UP": 1, "DOWN": -1, None: 0}
+        delta = (values.get(new_value, 0) - values.get(old_value, 0)) * VOTE_KARMA
+        return delta if is_good else -delta
+
+    # karma change when a skill endorsement is given (True) or removed (False)
+    @staticmethod
+    def endorsement_delta(given):
+        return ENDORSEMENT_KARMA if given else -ENDORSEMENT_KARMA
+
+    # atomically adds delta to the student's karma score without reading any reviews/votes
+    @staticmethod
+    def apply_delta(student, delta):
+        if delta:
+            Karma.objects.filter(student=student).update(score=F('score') + delta)
+            School.bump_karma_version(student.school_id)
+
+    def calculate_score(self):
+        karma=DEFAULT_KARMA
         reviews=Review.objects.filter(student=self.student)
         for review in reviews:
             num_upvotes= Vote.objects.filter(review=review, value="UP").count()
             num_downvotes= Vote.objects.filter(review=review, value="DOWN").count()
-            if review.is_good==True:
-                karma= karma + 50 + (num_upvotes*5) - (num_downvotes*5)
-            else:
-                karma= karma - 50 - (num_upvotes*5) + (num_downvotes*5)
+            karma= karma + Karma.review_delta(review.is_good, num_upvotes - num_downvotes)
         
         lead= Endorsement.objects.filter(student=self.student, leadership=True).count()
         respect= Endorsement.objects.filter(student=self.student, respect=True).count()
         punc= Endorsement.objects.filter(student=self.student, punctuality=True).count()
         part= Endorsement.objects.filter(student=self.student, participation=True).count()
         team= Endorsement.objects.filter(student=self.student, teamwork=True).count()
-        karma= karma + (lead*10) + (respect*10) + (punc*10) + (part*10) + (team*10)
+        karma= karma + (lead + respect + punc + part + team) * ENDORSEMENT_KARMA
+        return karma
 
-        self.score = karma
+    # full recomputation - slow for students with many reviews, use apply_delta for regular updates
+    def update_score(self):
+        self.score = self.calculate_score()
         self.save()
     
     def __str__(self):
@@ -182,19 +326,24 @@ class Karma (models.Model):
 # Stats : for displaying number of upvotes and downvotes per review
 # must be created each time a review is created
 # call by [review object].stats.upvotes or [review object].stats.downvotes
+# the counters are maintained by the voting path (see Stats.record_vote) - run the
+# verify_counters management command to check them against the Vote table
 
 class Stats (models.Model):
     review= models.OneToOneField(Review, on_delete=models.CASCADE, primary_key=True)
-
-    @property
-    def upvotes(self):
-        num_upvotes= Vote.objects.filter(review=self.review, value="UP").count()
-        return num_upvotes
-
-    @property
-    def downvotes(self):
-        num_downvotes= Vote.objects.filter(review=self.review, value="DOWN").count()
-        return num_downvotes
+    upvotes= models.PositiveIntegerField(default=0)
+    downvotes= models.PositiveIntegerField(default=0)
+
+    # atomically moves one vote on the review from old_value to new_value ("UP", "DOWN" or None)
+    @staticmethod
+    def record_vote(review, old_value, new_value):
+        changes = {}
+        for value, field in (("UP", "upvotes"), ("DOWN", "downvotes")):
+            delta = int(new_value == value) - int(old_value == value)
+            if delta:
+                changes[field] = F(field) + delta
+        if changes:
+            Stats.objects.filter(review=review).update(**changes)
 
     def __str__(self):
         return 'upvotes: %s  downvotes: %s' % (self.upvotes, self.downvotes)
@@ -218,9 +367,141 @@ class Activity (models.Model):
     created_at= models.DateTimeField(auto_now_add=True)
     parameter = models.TextField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='activity_user_recent_idx'),
+        ]
+
     def __str__(self):
         return '%s user: %s message: %s parameter: %s' % (timezone.localtime(self.created_at).strftime("%d/%m/%Y, %H:%M"), self.user, self.message, self.parameter)
     
     @property
     def timestamp(self):
-        return '%s' % (timezone.localtime(self.created_at).strftime("%d/%m/%Y, %-I:%M%p"))
\ No newline at end of file
+        return '%s' % (timezone.localtime(self.created_at).strftime("%d/%m/%Y, %-I:%M%p"))
+
+
+
+# Leaderboard Export : a leaderboard PDF rendered in the background (see base/exports.py)
+# exports are reused until the school's karma version changes
+
+class LeaderboardExport (models.Model):
+    STATUS = (
+        ("PENDING", "Pending"),
+        ("RUNNING", "Running"),
+        ("DONE", "Done"),
+        ("FAILED", "Failed")
+    )
+
+    school= models.ForeignKey(School, on_delete=models.CASCADE)
+    karma_version= models.PositiveIntegerField()
+    top= models.PositiveIntegerField(default=0) # 0 for the full leaderboard
+    status= models.CharField(choices=STATUS, max_length=7, default="PENDING")
+    pdf= models.BinaryField(null=True, editable=False)
+    created_at= models.DateTimeField(auto_now_add=True)
+    started_at= models.DateTimeField(null=True) # when a worker claimed the export (see tasks.claim_job)
+    finished_at= models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('school', 'karma_version', 'top',)
+
+    def __str__(self):
+        return '%s top: %s version: %s status: %s' % (self.school.name, self.top, self.karma_version, self.status)
+
+    @property
+    def in_progress(self):
+        return self.status in ("PENDING", "RUNNING")
+
+    @property
+    def filename(self):
+        if self.top:
+            return f'{self.school.name}_student_leaderboard_top{self.top}.pdf'
+        return f'{self.school.name}_student_leaderboard.pdf'
+
+
+
+# Roster import job: an uploaded csv file of student names, imported by the background worker
+# (see base/roster.py). The counters are updated after every batch so the dashboard can show progress
+
+class ImportJob (models.Model):
+    STATUS = (
+        ("PENDING", "Pending"),
+        ("RUNNING", "Running"),
+        ("DONE", "Done"),
+        ("FAILED", "Failed")
+    )
+
+    school= models.ForeignKey(School, on_delete=models.CASCADE)
+    csv_file= models.FileField(upload_to='roster-imports/', blank=True) # removed once the import has finished
+    filename= models.CharField(max_length=255)
+    status= models.CharField(choices=STATUS, max_length=7, default="PENDING")
+    processed= models.PositiveIntegerField(default=0)
+    inserted= models.PositiveIntegerField(default=0)
+    skipped= models.PositiveIntegerField(default=0)
+    error_count= models.PositiveIntegerField(default=0)
+    errors= models.TextField(blank=True) # one reported error per line
+    created_at= models.DateTimeField(auto_now_add=True)
+    started_at= models.DateTimeField(null=True) # when a worker claimed the import (see tasks.claim_job)
+    finished_at= models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '%s %s status: %s' % (self.school.name, self.filename, self.status)
+
+    @property
+    def error_list(self):
+        return self.errors.splitlines()
+
+    def progress(self):
+        return {
+            'status' : self.status,
+            'processed' : self.processed,
+            'inserted' : self.inserted,
+            'skipped' : self.skipped,
+            'error_count' : self.error_count,
+            'errors' : self.error_list
+        }
+
+
+
+# AI generated summary of a student's reviews, reused until the reviews it was generated from change
+# input_hash identifies those reviews (see base/summaries.py)
+
+class StudentSummary (models.Model):
+    KIND = (
+        ("PROFILE", "Profile"),  # summary of the latest reviews, shown on the student's profile
+        ("LETTER", "Letter")     # summary of the best positive reviews, used for recommendation letters
+    )
+
+    student= models.ForeignKey(Student, on_delete=models.CASCADE)
+    kind= models.CharField(choices=KIND, max_length=7)
+    input_hash= models.CharField(max_length=64)
+    text= models.TextField()
+    updated_at= models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('student', 'kind',)
+
+    def __str__(self):
+        return '%s %s summary' % (self.student.name, self.kind)
+
+
+
+# One call to the text generation backend, saved for the llm_metrics command (see base/metrics.py)
+
+class LLMCall (models.Model):
+    OUTCOME = (
+        ("success", "Success"),
+        ("timeout", "Timeout"),
+        ("error", "Error"),
+        ("unavailable", "Unavailable")  # not attempted, the circuit breaker was open
+    )
+
+    operation= models.CharField(max_length=30)
+    outcome= models.CharField(choices=OUTCOME, max_length=11)
+    latency= models.FloatField() # seconds, including retries
+    input_tokens= models.PositiveIntegerField(default=0)
+    output_tokens= models.PositiveIntegerField(default=0)
+    attempts= models.PositiveIntegerField(default=0)
+    created_at= models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '%s %s %s: %.3fs' % (timezone.localtime(self.created_at).strftime('%d/%m/%Y, %H:%M'), self.operation, self.outcome, self.latency)
@@ -0,0 +1,149 @@
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from collections.abc import Sequence
+from datetime import date
+import base64
+import binascii
+import json
+
+
+# Keyset (cursor) pagination
+# Instead of counting and skipping rows with OFFSET, each page continues from the last row of the
+# previous one: WHERE (created_at, id) < (last created_at, last id) ORDER BY created_at DESC, id DESC
+# LIMIT per_page. With an index on the ordering, any page costs the same as the first one.
+# Pages are opened with an opaque cursor (?cursor=...) taken from next_cursor / previous_cursor.
+# The ordering must end with a unique field (eg. id) and its fields can't be null.
+# KeysetPage has the same interface as a Django Page for what the templates use (iteration, indexing,
+# has_next, has_previous, has_other_pages, paginator.count), but there are no page numbers.
+# Listings that need page numbers use the numbered mode of paginate() instead (see pagination.html)
+
+RECENT_FIRST = ('-created_at', '-id')
+
+
+# The page of the ordered queryset asked for by the request: a KeysetPage (?cursor=...), or with
+# numbered=True a Django Page (?page=...) of a Paginator over the ordered queryset, so the database
+# still does the ORDER BY ... LIMIT, but every page costs a COUNT and deep pages an OFFSET
+
+def paginate(request, queryset, per_page, ordering=RECENT_FIRST, numbered=False):
+    if numbered:
+        return Paginator(queryset.order_by(*ordering), per_page).get_page(request.GET.get('page'))
+    return KeysetPaginator(queryset, per_page, ordering).page(request.GET.get('cursor'))
+
+
+class KeysetPaginator:
+    def __init__(self, queryset, per_page, ordering=RECENT_FIRST):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+    # total number of rows, only counted if a template asks for it
+    @cached_property
+    def count(self):
+        return self.queryset.count()
+
+    # the page the cursor points to, or the first page if there is no cursor or it is invalid
+    def page(self, cursor=None):
+        position = self.decode(cursor)
+        if position is None:
+            return self.fetch()
+        backwards, values = position
+        page = self.fetch(values, backwards)
+        if not page:   # the rows around the cursor were deleted
+            return self.fetch()
+        return page
+
+    def fetch(self, values=None, backwards=False):
+        ordering = [('-' if descending != backwards else '') + name for name, descending in self.ordering]
+        rows = self.queryset.order_by(*ordering)
+        if values is not None:
+            rows = rows.filter(self.after(values, backwards))
+        rows = list(rows[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+            return KeysetPage(rows, self, has_next=True, has_previous=more)
+        return KeysetPage(rows, self, has_next=more, has_previous=values is not None)
+
+    # rows that come after the values in the ordering (before them if backwards):
+    # (a > x) OR (a = x AND b > y) OR ... with < instead of > for descending fields
+    def after(self, values, backwards):
+        condition = Q()
+        for i, (name, descending) in enumerate(self.ordering):
+            lookup = 'lt' if descending != backwards else 'gt'
+            term = Q(**{f'{name}__{lookup}': values[i]})
+            for j, (previous, _) in enumerate(self.ordering[:i]):
+                term &= Q(**{previous: values[j]})
+            condition |= term
+        return condition
+
+    @property
+    def names(self):
+        return [name for name, descending in self.ordering]
+
+    def encode(self, row, backwards=False):
+        values = []
+        for name in self.names:
+            value = getattr(row, name)
+            values.append(value.isoformat() if isinstance(value, date) else value)
+        data = json.dumps([backwards, values], separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    # (backwards, values) from a cursor, None if it isn't one of ours
+    def decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            backwards, values = json.loads(data)
+            if not isinstance(backwards, bool) or len(values) != len(self.ordering):
+                return None
+            return backwards, [self.to_python(name, value) for name, value in zip(self.names, values)]
+        except (binascii.Error, ValueError, TypeError, ValidationError):
+            return None
+
+    def to_python(self, name, value):
+        try:
+            field = self.queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:   # an annotation, eg. helpfulness
+            return value
+        return field.to_python(value)
+
+
+class KeysetPage(Sequence):
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.rows = list(object_list)
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<Keyset page of %s>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    # the cursors are taken from the rows, so they still work if object_list is replaced by the view
+    # (eg. with (review, vote) pairs)
+    @cached_property
+    def next_cursor(self):
+        return self.paginator.encode(self.rows[-1]) if self.has_next() else None
+
+    @cached_property
+    def previous_cursor(self):
+        return self.paginator.encode(self.rows[0], backwards=True) if self.has_previous() else None
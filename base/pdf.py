@@ -0,0 +1,17 @@
+from xhtml2pdf import pisa
+import io
+
+
+# HTML to PDF conversion with xhtml2pdf
+# Rendering a PDF is CPU bound, so background jobs run it in a separate process (see
+# tasks.run_in_process) where it doesn't hold the GIL of the web process. This module doesn't use
+# Django, so it can be imported by those processes on its own
+
+# returns the PDF as bytes, or None if xhtml2pdf reported an error
+
+def html_to_pdf(html):
+    result = io.BytesIO()
+    pdf = pisa.pisaDocument(io.BytesIO(html.encode("ISO-8859-1")), result)
+    if pdf.err:
+        return None
+    return result.getvalue()
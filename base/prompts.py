@@ -0,0 +1,72 @@
+from django.conf import settings
+
+
+# Prompt building with a token budget
+# Tokens are estimated locally at about 4 characters per token (close enough for English text with
+# the GPT tokenizers, and no tokenizer has to be installed). Review texts are packed into the prompt
+# until settings.LLM_INPUT_TOKEN_BUDGET is used up, and max_tokens is sized to the expected output
+# instead of a flat 1000, while always leaving the prompt room in the model's context
+
+CHARS_PER_TOKEN = 4
+SUMMARY_MIN_TOKENS = 64
+SUMMARY_MAX_TOKENS = 300
+LETTER_MAX_TOKENS = 700     # a one page letter is around 400 words
+MIN_REVIEW_TOKENS = 25      # a review is only cut short if at least this much of it fits
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, tokens):
+    if estimate_tokens(text) <= tokens:
+        return text
+    cut = text[:max(tokens - 1, 0) * CHARS_PER_TOKEN]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]  # don't end in the middle of a word
+    return cut + '...'
+
+
+# Returns the texts that fit in the budget, in the order given (most important first).
+# Whitespace is normalized and repeated texts are dropped, a text that doesn't fit is cut short if
+# enough of it fits, and later shorter texts can still fill up what is left of the budget
+
+def pack_texts(texts, budget):
+    packed = []
+    seen = set()
+    used = 0
+    for text in texts:
+        text = ' '.join(text.split())
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        tokens = estimate_tokens(text)
+        if used + tokens <= budget:
+            packed.append(text)
+            used += tokens
+        elif budget - used >= MIN_REVIEW_TOKENS:
+            packed.append(truncate_to_tokens(text, budget - used))
+            used = budget
+    return packed
+
+
+# max_tokens for a completion of the prompt: the expected output, capped by what the context has left
+
+def output_tokens(prompt, expected):
+    available = settings.LLM_CONTEXT_TOKENS - estimate_tokens(prompt)
+    return max(1, min(expected, available))
+
+
+# Returns (prompt, max_tokens) to summarize the review texts, the most important first
+
+def summary_prompt(texts):
+    packed = pack_texts(texts, settings.LLM_INPUT_TOKEN_BUDGET)
+    prompt = "Summarize '" + "\n".join(packed) + "'"
+    # a summary is about half as long as what it summarizes, within limits
+    input_tokens = sum(estimate_tokens(text) for text in packed)
+    expected = min(SUMMARY_MAX_TOKENS, max(SUMMARY_MIN_TOKENS, input_tokens // 2))
+    return prompt, output_tokens(prompt, expected)
+
+
+def letter_max_tokens(prompt):
+    return output_tokens(prompt, LETTER_MAX_TOKENS)
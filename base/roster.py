@@ -0,0 +1,190 @@
+from django.db import transaction
+from django.utils import timezone
+from .models import School, Student, Karma, EndorsementStats, ImportJob
+from . import tasks
+import csv
+import io
+
+
+# Bulk import of student rosters (eg. from an uploaded csv file)
+# The file is decoded and validated row by row as it is read, and students are inserted in
+# batches, so memory use is bounded by the batch size rather than by the size of the file
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+NAME_MAX_LENGTH = Student._meta.get_field('name').max_length
+
+
+class RosterError(Exception):
+    pass
+
+
+# counts for one import, with the first MAX_REPORTED_ERRORS row errors
+
+class ImportResult:
+    def __init__(self):
+        self.processed = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'Line {line}: {message}')
+
+
+
+# Raw binary stream over the chunks of an uploaded file, so the upload can be decoded
+# incrementally with io.TextIOWrapper instead of being read into memory at once
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def open_roster(upload):
+    raw = io.BufferedReader(ChunkReader(upload.chunks()))
+    # undecodable bytes become U+FFFD so they can be reported against their row
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', errors='replace', newline='')
+
+
+
+# yields the valid student names in the csv stream, recording invalid rows in result
+
+def read_roster(stream, result):
+    reader = csv.DictReader(stream)
+    if not reader.fieldnames or 'name' not in reader.fieldnames:
+        raise RosterError('The csv file must have a "name" column')
+
+    try:
+        for row in reader:
+            result.processed += 1
+            name = (row.get('name') or '').strip()
+            if not name:
+                result.add_error(reader.line_num, 'missing student name')
+            elif len(name) > NAME_MAX_LENGTH:
+                result.add_error(reader.line_num, f'student name is longer than {NAME_MAX_LENGTH} characters')
+            elif '\ufffd' in name:
+                result.add_error(reader.line_num, 'student name is not valid UTF-8')
+            else:
+                yield name
+    except csv.Error as e:
+        result.add_error(reader.line_num, f'could not be parsed ({e}), the rest of the file was skipped')
+
+
+
+# Imports the roster in the uploaded csv file into the school, returns an ImportResult
+# on_batch (optional) is called with the result after each batch is saved
+
+def import_roster(school, upload, batch_size=IMPORT_BATCH_SIZE, result=None, on_batch=None):
+    result = result or ImportResult()
+    names = read_roster(open_roster(upload), result)
+    import_students(school, names, batch_size, result=result, on_batch=on_batch)
+    return result
+
+
+
+# whether this process can read the csv file of an ImportJob. Uploads are stored in MEDIA_ROOT, which
+# may be local to the web process that received them, so run_jobs leaves the imports it can't read
+# pending for a process that can (point DJANGO_MEDIA_ROOT at shared storage to let it run them all)
+
+def upload_available(job_id):
+    name = ImportJob.objects.filter(pk=job_id).values_list('csv_file', flat=True).first()
+    return bool(name) and ImportJob._meta.get_field('csv_file').storage.exists(name)
+
+
+
+# background task: imports the csv file of an ImportJob, saving the job's counters after every batch
+# The job is claimed first, so a job that is already running elsewhere is skipped, and the csv file
+# is deleted once the import has finished, whatever its outcome (see tasks.claim_job and run_jobs)
+
+def run_import_job(job_id):
+    if not tasks.claim_job(ImportJob, job_id):
+        return
+    job = ImportJob.objects.select_related('school').get(pk=job_id)
+
+    # started_at doubles as a heartbeat, so a long import isn't taken for abandoned and run again
+    def save_progress(result):
+        ImportJob.objects.filter(pk=job.pk).update(
+            processed=result.processed, inserted=result.inserted, skipped=result.skipped, error_count=result.error_count,
+            started_at=timezone.now()
+        )
+
+    result = ImportResult()
+    status = "FAILED"
+    try:
+        with job.csv_file.open('rb') as upload:
+            import_roster(job.school, upload, result=result, on_batch=save_progress)
+        status = "DONE"
+    except RosterError as e:
+        result.add_error(1, str(e))
+    except (OSError, ValueError):  # the file is missing (eg. it was stored by another machine)
+        result.add_error(1, 'the uploaded file could not be read, please upload it again')
+    finally:
+        save_progress(result)
+        ImportJob.objects.filter(pk=job.pk).update(status=status, errors='\n'.join(result.errors), finished_at=timezone.now())
+        job.csv_file.delete(save=False)
+        ImportJob.objects.filter(pk=job.pk).update(csv_file='')
+
+
+
+# Adds the students named in names to the school, together with their Karma and EndorsementStats
+# objects. Names are de-duplicated and inserted with bulk_create one batch at a time, each batch in
+# its own transaction, so a re-run of an interrupted import simply skips the students already added.
+# Returns (number inserted, number skipped as duplicates)
+
+def import_students(school, names, batch_size=IMPORT_BATCH_SIZE, result=None, on_batch=None):
+    result = result or ImportResult()
+    batch = {}  # dict rather than set, to keep the file's order
+
+    for name in names:
+        if name in batch:
+            result.skipped += 1
+            continue
+        batch[name] = None
+        if len(batch) >= batch_size:
+            import_batch(school, list(batch), result, on_batch)
+            batch = {}
+    if batch:
+        import_batch(school, list(batch), result, on_batch)
+
+    return result.inserted, result.skipped
+
+
+def import_batch(school, names, result, on_batch):
+    with transaction.atomic():
+        existing = set(Student.objects.filter(school=school, name__in=names).values_list('name', flat=True))
+        new_names = [name for name in names if name not in existing]
+        if new_names:
+            insert_students(school, new_names)
+            School.bump_karma_version(school.pk)
+    result.inserted += len(new_names)
+    result.skipped += len(existing)
+    if on_batch:
+        on_batch(result)
+
+
+def insert_students(school, names):
+    students = Student.objects.bulk_create([Student(name=name, school=school) for name in names])
+    if students[0].pk is None:  # the database can't return the new ids from a bulk insert
+        students = list(Student.objects.filter(school=school, name__in=names))
+    Karma.objects.bulk_create([Karma(student=student, school=school) for student in students])
+    EndorsementStats.objects.bulk_create([EndorsementStats(student=student) for student in students])
+    return len(students)
@@ -0,0 +1,42 @@
+from django.core.cache import cache
+import time
+
+
+# Single-flight calls: concurrent callers asking for the same key share one call to func instead
+# of each making their own (eg. several teachers opening the same profile at once).
+# The first caller takes a lock in the cache with cache.add() and runs func, the others poll for
+# its result. With the default local memory cache this coalesces calls within a process, a shared
+# cache backend (DJANGO_CACHE_BACKEND) coalesces them across processes too.
+
+LOCK_TIMEOUT = 60       # seconds before the lock of a caller that died is released
+RESULT_TIMEOUT = 60     # seconds a result is kept for callers that were waiting on it
+POLL_INTERVAL = 0.1
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+def single_flight(key, func, wait_timeout=30):
+    lock_key = f'single-flight-lock:{key}'
+    result_key = f'single-flight-result:{key}'
+    deadline = time.monotonic() + wait_timeout
+
+    while True:
+        result = cache.get(result_key)
+        if result is not None:
+            return result
+
+        if cache.add(lock_key, True, LOCK_TIMEOUT):
+            try:
+                result = func()
+                if result is not None:
+                    cache.set(result_key, result, RESULT_TIMEOUT)
+                return result
+            finally:
+                cache.delete(lock_key)
+
+        # another caller is running func, if it fails the next waiter to get the lock retries
+        if time.monotonic() >= deadline:
+            raise SingleFlightTimeout(f'Timed out waiting for {key}')
+        time.sleep(POLL_INTERVAL)
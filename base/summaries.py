@@ -0,0 +1,137 @@
+from .models import Student, Review, StudentSummary
+from . import tasks
+from .singleflight import single_flight, SingleFlightTimeout
+from .llm import complete, time_left, LLMUnavailable
+from .prompts import summary_prompt, letter_max_tokens
+from .metrics import metrics
+import hashlib
+
+
+# AI summaries of a student's reviews
+# A summary is stored per student and kind, together with a hash of the reviews it was generated
+# from. It is reused as long as the hash matches, so OpenAI is only called again once a review
+# is added, edited or deleted. Views never wait on OpenAI: writing a review queues a refresh of the
+# profile summary on the background worker, and the profile shows the last summary that was generated
+
+PROFILE_REVIEWS = 10    # only use the 10 latest reviews to reduce API cost
+LETTER_REVIEWS = 5      # and the 5 best positive reviews for recommendation letters
+
+
+def summary_reviews(student, kind):
+    if kind == "LETTER":
+        # positive reviews only, chatGPT wont write a recommendation letter with negative reviews
+        reviews = Review.objects.filter(student=student, is_good=True).order_by('-rating', '-created_at')[:LETTER_REVIEWS]
+    else:
+        reviews = Review.objects.filter(student=student).order_by('-created_at')[:PROFILE_REVIEWS]
+    return list(reviews.values_list('id', 'text'))
+
+
+def input_hash(reviews):
+    digest = hashlib.sha256()
+    for review_id, text in reviews:
+        digest.update(f'{review_id}:{len(text)}:{text}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Summary of a student's reviews that may need to be (re)generated. The database is read when it
+# is created, generate() only calls the backend, so it can run in another thread while the caller
+# carries on with other work
+
+class PendingSummary:
+    def __init__(self, student, kind):
+        self.student = student
+        self.kind = kind
+        self.operation = f'{kind.lower()}_summary'  # name in the metrics
+        reviews = summary_reviews(student, kind)
+        self.digest = input_hash(reviews) if reviews else None
+        self.stored = StudentSummary.objects.filter(student=student, kind=kind).first() if reviews else None
+        self.prompt, self.max_tokens = summary_prompt([text for review_id, text in reviews])
+
+    @property
+    def current_text(self):
+        # the stored summary if it was generated from the student's current reviews
+        if self.stored and self.stored.input_hash == self.digest:
+            return self.stored.text
+        return None
+
+    @property
+    def stale_text(self):
+        return self.stored.text if self.stored else None
+
+    @property
+    def needs_generation(self):
+        return self.digest is not None and self.current_text is None
+
+    def generate(self, deadline=None, retries=None):
+        # concurrent refreshes of the same reviews share one completion
+        key = f'summary:{self.student.pk}:{self.kind}:{self.digest}'
+        return single_flight(key, lambda: complete(self.prompt, max_tokens=self.max_tokens, operation=self.operation, deadline=deadline, retries=retries), **wait_until(deadline))
+
+    def save(self, text):
+        StudentSummary.objects.update_or_create(student=self.student, kind=self.kind, defaults={'input_hash': self.digest, 'text': text})
+
+
+
+# Returns the student's summary of the given kind, generating it if the reviews changed since it was
+# last generated. Returns None if the student has no reviews to summarize, or if the summary could
+# not be generated (in which case the last known summary is returned instead, if there is one)
+
+def get_summary(student, kind="PROFILE"):
+    pending = PendingSummary(student, kind)
+    if not pending.needs_generation:
+        return pending.current_text
+
+    try:
+        text = pending.generate()
+    except (LLMUnavailable, SingleFlightTimeout):
+        metrics.count(pending.operation, 'fallbacks')
+        return pending.stale_text
+    pending.save(text)
+    return text
+
+
+
+# recommendation letter for the prompt, requests for an identical prompt made at the same time
+# share one completion. deadline and retries are passed on to complete()
+
+def generate_letter(prompt, deadline=None, retries=None):
+    key = 'letter:' + hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return single_flight(key, lambda: complete(prompt, max_tokens=letter_max_tokens(prompt), operation='letter', deadline=deadline, retries=retries), **wait_until(deadline))
+
+
+# single_flight() arguments so that waiting on another caller's completion also stops at the deadline
+
+def wait_until(deadline):
+    return {'wait_timeout': time_left(deadline)} if deadline is not None else {}
+
+
+
+# the last summary generated for the student (None if there is none yet), never calls OpenAI
+# A missing or stale summary is refreshed in the background, so a refresh that failed or was lost
+# with its worker is queued again the next time the summary is shown
+
+def last_summary(student, kind="PROFILE"):
+    pending = PendingSummary(student, kind)
+    if pending.needs_generation:
+        request_summary_refresh(student, kind)
+    metrics.cache_lookup(pending.operation, hit=pending.stored is not None)
+    return pending.current_text or pending.stale_text
+
+
+# queues a refresh of one of the student's summaries, once the current transaction commits
+# Review changes only refresh the PROFILE summary, the LETTER summary is refreshed when a letter is written
+
+def request_summary_refresh(student, kind="PROFILE"):
+    tasks.enqueue(refresh_summary, student.pk, kind)
+
+
+# background task: brings the summary up to date with the student's reviews
+
+def refresh_summary(student_id, kind="PROFILE"):
+    student = Student.objects.filter(pk=student_id).first()
+    if student is None:
+        return
+    try:
+        get_summary(student, kind)
+    finally:
+        metrics.flush()
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import multiprocessing
+import threading
+
+
+# Local background worker: runs slow jobs (eg. PDF rendering) in a small thread pool inside the
+# web process, so no external broker is needed. Jobs are queued once the current transaction
+# commits, so they always see the rows that were written by the request that queued them.
+# With BACKGROUND_TASKS_EAGER = True jobs run synchronously instead (used by the tests).
+#
+# Jobs that must not be lost (leaderboard exports, roster imports) are also saved as rows with a
+# status. A job claims its row before running (see claim_job), and the run_jobs management command
+# runs every row that is still pending or was abandoned by a process that died, so a job queued in
+# a web process that was recycled or redeployed still runs.
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='background')
+        return _executor
+
+
+def enqueue(func, *args, **kwargs):
+    if settings.BACKGROUND_TASKS_EAGER:
+        transaction.on_commit(lambda: run(func, *args, **kwargs))
+    else:
+        transaction.on_commit(lambda: get_executor().submit(run_in_thread, func, *args, **kwargs))
+
+
+def run(func, *args, **kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+
+
+def run_in_thread(func, *args, **kwargs):
+    try:
+        run(func, *args, **kwargs)
+    finally:
+        connection.close()  # each worker thread has its own database connection
+
+
+
+# CPU bound work (eg. html_to_pdf) runs in a pool of separate processes, so it doesn't hold the GIL
+# of the process serving requests. The processes are spawned rather than forked from the (threaded)
+# web process, so func must be importable without Django and its arguments and result picklable
+
+def get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=settings.BACKGROUND_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+
+def run_in_process(func, *args):
+    if settings.BACKGROUND_TASKS_EAGER:
+        return func(*args)
+    return get_process_pool().submit(func, *args).result()
+
+
+
+# Jobs saved as rows of a model with status (PENDING, RUNNING, DONE or FAILED) and started_at fields.
+# A row is runnable while it is PENDING, or RUNNING with a started_at older than
+# settings.BACKGROUND_JOB_TIMEOUT seconds (the process running it died). Long jobs refresh started_at
+# as they make progress, so they are not run twice
+
+def runnable_jobs(model):
+    abandoned_before = timezone.now() - timedelta(seconds=settings.BACKGROUND_JOB_TIMEOUT)
+    return model.objects.filter(Q(status="PENDING") | Q(status="RUNNING", started_at__lt=abandoned_before))
+
+
+# marks the job as RUNNING if it is runnable, returns False if another process has it or it has finished
+
+def claim_job(model, pk):
+    return runnable_jobs(model).filter(pk=pk).update(status="RUNNING", started_at=timezone.now()) == 1
@@ -1,12 +1,27 @@
-from django.test import TestCase
-from django.db import models
+from django.test import TestCase, override_settings
+from django.db import models, IntegrityError
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import Group, User
 from django.utils import timezone
 from datetime import datetime
 from django.urls import reverse
-from base.models import Admin, School, Staff, Student, Review, Endorsement, EndorsementStats, Vote, Stats, Staff_Inbox, Activity
+from base.models import Admin, School, Staff, Student, Review, Endorsement, EndorsementStats, Vote, Stats, Staff_Inbox, Activity, Karma, StudentSummary, LLMCall
+from base.summaries import get_summary, generate_letter
+from base.prompts import estimate_tokens, pack_texts, summary_prompt, SUMMARY_MAX_TOKENS
+from base.metrics import metrics, percentile
+from base.singleflight import single_flight, SingleFlightTimeout
+from base.pagination import KeysetPaginator
+from base.voting import cast_vote
+from base.endorsements import toggle_endorsement
+from base.llm import StubBackend, OpenAIBackend, CircuitBreaker, LLMError, LLMUnavailable, get_backend, get_breaker, create_breaker, complete
 from base.forms import AdminRegistrationForm
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.management import call_command
+from django.core.cache import cache
+import io
+from unittest import mock
+import threading
+import time
 
 
 #
@@ -93,6 +108,12 @@ class StudentModelTest(TestCase):
     def test_str_method(self):
         self.assertEquals(str(self.student), 'John Doe : Pres')
 
+    def test_no_duplicate_students(self):
+        out = io.StringIO()
+        call_command('duplicate_students', '--rename', stdout=out)
+        self.assertIn('No duplicate students.', out.getvalue())
+        self.assertEqual(Student.objects.get().name, 'John Doe')
+
 
 #
 #   REVIEW MODEL TESTS
@@ -167,13 +188,35 @@ class EndorsementModelTest(TestCase):
         self.assertEqual(str(self.endorsement), f"staff: {self.staff.user.get_full_name()} leadership: True respect: False punctuality: True participation: False teamwork: True")
 
     def test_endorsement_default_attributes(self):
-        endorsement = Endorsement.objects.create(student=self.student, staff=self.staff)
+        other_student = Student.objects.create(name="John Doe", school=self.school)
+        endorsement = Endorsement.objects.create(student=other_student, staff=self.staff)
         self.assertEqual(endorsement.leadership, False)
         self.assertEqual(endorsement.respect, False)
         self.assertEqual(endorsement.punctuality, False)
         self.assertEqual(endorsement.participation, False)
         self.assertEqual(endorsement.teamwork, False)
 
+    def test_one_endorsement_per_student(self):
+        with self.assertRaises(IntegrityError):
+            Endorsement.objects.create(respect=True, student=self.student, staff=self.staff)
+
+    def test_toggle_endorsement_after_concurrent_create(self):
+        Karma.objects.create(student=self.student)
+        EndorsementStats.objects.create(student=self.student, leadership=1, punctuality=1, teamwork=1)
+        # the first lookup misses, as if another request created the row right after it
+        first = QuerySet.first
+        lookups = []
+        def miss_first_lookup(queryset):
+            lookups.append(queryset)
+            return None if len(lookups) == 1 else first(queryset)
+        with mock.patch.object(QuerySet, 'first', miss_first_lookup):
+            result = toggle_endorsement(self.staff, self.student, 'respect')
+        self.assertTrue(result.given)
+        self.assertEqual((result.count, result.karma), (1, 110))
+        self.assertEqual(Endorsement.objects.filter(student=self.student, staff=self.staff).count(), 1)
+        self.endorsement.refresh_from_db()
+        self.assertTrue(self.endorsement.respect)
+
 #
 #   ENDORSEMENT STATS TESTS
 #
@@ -193,6 +236,9 @@ class EndorsementStatsModelTest(TestCase):
 
     def test_endorsement_stats_attributes(self):
         endorsement_stats = EndorsementStats.objects.create(student=self.student)
+        for skill in ('leadership', 'punctuality', 'teamwork'):
+            EndorsementStats.record_endorsement(self.student, skill, True)
+        endorsement_stats.refresh_from_db()
         self.assertEqual(endorsement_stats.school, self.school)
         self.assertEqual(endorsement_stats.leadership, 1)
         self.assertEqual(endorsement_stats.respect, 0)
@@ -209,6 +255,41 @@ class EndorsementStatsModelTest(TestCase):
         self.assertEqual(endorsement_stats.participation, 0)
         self.assertEqual(endorsement_stats.teamwork, 0)
 
+    def test_record_endorsement_removed(self):
+        endorsement_stats = EndorsementStats.objects.create(student=self.student, leadership=1)
+        EndorsementStats.record_endorsement(self.student, 'leadership', False)
+        endorsement_stats.refresh_from_db()
+        self.assertEqual(endorsement_stats.leadership, 0)
+
+    def test_school_highest(self):
+        cache.clear()
+        EndorsementStats.objects.create(student=self.student, leadership=3, teamwork=1)
+        student = Student.objects.create(name="Jane Doe", school=self.school)
+        EndorsementStats.objects.create(student=student, leadership=1, respect=2)
+        other_school = School.objects.create(name='PRES')
+        other_student = Student.objects.create(name="Jim Doe", school=other_school)
+        EndorsementStats.objects.create(student=other_student, leadership=10, punctuality=10)
+        self.assertEqual(EndorsementStats.school_highest(self.school), {'leadership': 3, 'respect': 2, 'punctuality': 0, 'participation': 0, 'teamwork': 1})
+
+    def test_school_highest_invalidated(self):
+        cache.clear()
+        EndorsementStats.objects.create(student=self.student)
+        self.assertEqual(EndorsementStats.school_highest(self.school)['respect'], 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            EndorsementStats.record_endorsement(self.student, 'respect', True)
+            self.assertEqual(EndorsementStats.school_highest(self.school)['respect'], 0)  # not committed yet
+        self.assertEqual(EndorsementStats.school_highest(self.school)['respect'], 1)
+
+    def test_verify_counters_fix(self):
+        endorsement_stats = EndorsementStats.objects.create(student=self.student)
+        self.assertEqual(EndorsementStats.school_highest(self.school)['leadership'], 0)
+        call_command('verify_counters', '--fix', stdout=io.StringIO())
+        self.assertEqual(EndorsementStats.school_highest(self.school)['leadership'], 1)
+        endorsement_stats.refresh_from_db()
+        self.assertEqual(endorsement_stats.leadership, 1)
+        self.assertEqual(endorsement_stats.respect, 0)
+        self.assertEqual(endorsement_stats.teamwork, 1)
+
 #
 #   VOTE MODEL TESTS
 #
@@ -240,11 +321,62 @@ class VoteModelTest(TestCase):
         self.assertEqual(str(self.vote), f'staff: {self.review.staff} review: {self.review} value: UP')
     
     def test_vote_down(self):
-        vote = Vote.objects.create(staff=self.staff, review=self.review, value="DOWN")
+        other_review = Review.objects.create(staff=self.staff, student=self.student, text='This is another test review that is at least fifty characters.', rating=1, is_good=False)
+        vote = Vote.objects.create(staff=self.staff, review=other_review, value="DOWN")
         self.assertEqual(vote.value, "DOWN")
+
+    def test_one_vote_per_review(self):
+        with self.assertRaises(IntegrityError):
+            Vote.objects.create(staff=self.staff, review=self.review, value="DOWN")
+
+    def test_values_for(self):
+        other_review = Review.objects.create(staff=self.staff, student=self.student, text='This is another test review that is at least fifty characters.', rating=1, is_good=False)
+        unvoted_review = Review.objects.create(staff=self.staff, student=self.student, text='This is a third test review that is at least fifty characters.', rating=4, is_good=True)
+        Vote.objects.create(staff=self.staff, review=other_review, value="DOWN")
+        with self.assertNumQueries(1):
+            votes = Vote.values_for(self.staff, [self.review, other_review, unvoted_review])
+        self.assertEqual(votes, {self.review.pk: "UP", other_review.pk: "DOWN"})
+        self.assertEqual(Vote.values_for(self.staff, [other_review.pk]), {other_review.pk: "DOWN"})
     
     
 
+class CastVoteTest(TestCase):
+    def setUp(self):
+        self.school = School.objects.create(name='ASJA')
+        self.user = User.objects.create_user(username='asja', email='asja@gmail.com', password='testpassword')
+        self.staff = Staff.objects.create(user=self.user, school=self.school)
+        self.student = Student.objects.create(name="John Doe", school=self.school)
+        self.karma = Karma.objects.create(student=self.student)
+        self.review = Review.objects.create(staff=self.staff, student=self.student, text='This is a test review that is at least fifty characters.', rating=3, is_good=True)
+        Stats.objects.create(review=self.review)
+
+    def test_vote(self):
+        result = cast_vote(self.staff, self.review, "UP")
+        self.assertEqual((result.old_value, result.value), (None, "UP"))
+        self.assertEqual((result.upvotes, result.downvotes, result.karma), (1, 0, 105))
+        self.assertTrue(result.changed)
+        self.assertEqual(Vote.objects.get(staff=self.staff, review=self.review).value, "UP")
+
+    def test_switch_vote(self):
+        cast_vote(self.staff, self.review, "UP")
+        result = cast_vote(self.staff, self.review, "DOWN")
+        self.assertEqual((result.old_value, result.value), ("UP", "DOWN"))
+        self.assertEqual((result.upvotes, result.downvotes, result.karma), (0, 1, 95))
+        self.assertEqual(Vote.objects.filter(staff=self.staff, review=self.review).count(), 1)
+
+    def test_remove_vote(self):
+        cast_vote(self.staff, self.review, "DOWN")
+        result = cast_vote(self.staff, self.review, "DOWN")
+        self.assertEqual((result.old_value, result.value), ("DOWN", None))
+        self.assertEqual((result.upvotes, result.downvotes, result.karma), (0, 0, 100))
+        self.assertFalse(Vote.objects.filter(staff=self.staff, review=self.review).exists())
+
+    def test_invalid_vote(self):
+        with self.assertRaises(ValueError):
+            cast_vote(self.staff, self.review, "SIDEWAYS")
+        self.assertFalse(Vote.objects.exists())
+
+
 #
 #   STATS MODEL TESTS
 #
@@ -276,6 +408,8 @@ class StatsModelTest(TestCase):
         self.review = Review.objects.create(staff=self.staff, student=self.student, text='This is a test review that is at least fifty characters.', rating=3, is_good=True)
         self.stats = Stats.objects.create(review=self.review)
         self.vote1 = Vote.objects.create(staff=self.staff, review=self.review, value='UP')
+        Stats.record_vote(self.review, None, 'UP')
+        self.stats.refresh_from_db()
 
         #student without votes on review
         self.student2 = Student.objects.create(name = "Jane Doe",school=self.school)
@@ -303,13 +437,123 @@ class StatsModelTest(TestCase):
     def test_multiple_upvotes(self):
         vote2 = Vote.objects.create(staff=self.staff, review=self.review_empty, value='UP')
         vote3 = Vote.objects.create(staff=self.staff2, review=self.review_empty, value='UP')
+        Stats.record_vote(self.review_empty, None, 'UP')
+        Stats.record_vote(self.review_empty, None, 'UP')
+        self.stats_empty.refresh_from_db()
         self.assertEqual(self.stats_empty.upvotes, 2)
 
     def test_multiple_upvotes(self):
         vote2 = Vote.objects.create(staff=self.staff, review=self.review_empty, value='DOWN')
         vote3 = Vote.objects.create(staff=self.staff2, review=self.review_empty, value='DOWN')
+        Stats.record_vote(self.review_empty, None, 'DOWN')
+        Stats.record_vote(self.review_empty, None, 'DOWN')
+        self.stats_empty.refresh_from_db()
         self.assertEqual(self.stats_empty.downvotes, 2)
 
+    def test_record_vote_switch(self):
+        Stats.record_vote(self.review, 'UP', 'DOWN')
+        self.stats.refresh_from_db()
+        self.assertEqual(self.stats.upvotes, 0)
+        self.assertEqual(self.stats.downvotes, 1)
+
+    def test_record_vote_removed(self):
+        Stats.record_vote(self.review, 'UP', None)
+        self.stats.refresh_from_db()
+        self.assertEqual(self.stats.upvotes, 0)
+        self.assertEqual(self.stats.downvotes, 0)
+
+    def test_verify_counters_fix(self):
+        Vote.objects.create(staff=self.staff2, review=self.review, value='DOWN')
+        call_command('verify_counters', '--fix', stdout=io.StringIO())
+        self.stats.refresh_from_db()
+        self.assertEqual(self.stats.upvotes, 1)
+        self.assertEqual(self.stats.downvotes, 1)
+
+#
+#   KARMA MODEL TESTS
+#
+class KarmaModelTest(TestCase):
+    def setUp(self):
+        self.school = School.objects.create(name='ASJA')
+        self.user = User.objects.create_user(
+            username='asja',
+            email='asja@gmail.com',
+            password='testpassword',
+            first_name='Test',
+            last_name='User'
+        )
+        self.staff = Staff.objects.create(user=self.user, school=self.school)
+        self.student = Student.objects.create(name="John Doe", school=self.school)
+        self.karma = Karma.objects.create(student=self.student)
+
+    def test_default_score(self):
+        self.assertEqual(self.karma.score, 100)
+
+    def test_review_delta(self):
+        self.assertEqual(Karma.review_delta(True), 50)
+        self.assertEqual(Karma.review_delta(False), -50)
+        self.assertEqual(Karma.review_delta(True, 2), 60)
+        self.assertEqual(Karma.review_delta(False, 2), -60)
+
+    def test_vote_delta(self):
+        self.assertEqual(Karma.vote_delta(True, None, "UP"), 5)
+        self.assertEqual(Karma.vote_delta(True, "UP", None), -5)
+        self.assertEqual(Karma.vote_delta(True, "UP", "DOWN"), -10)
+        self.assertEqual(Karma.vote_delta(False, None, "UP"), -5)
+        self.assertEqual(Karma.vote_delta(False, "UP", "DOWN"), 10)
+
+    def test_endorsement_delta(self):
+        self.assertEqual(Karma.endorsement_delta(True), 10)
+        self.assertEqual(Karma.endorsement_delta(False), -10)
+
+    def test_apply_delta(self):
+        Karma.apply_delta(self.student, 15)
+        self.karma.refresh_from_db()
+        self.assertEqual(self.karma.score, 115)
+
+    def test_apply_delta_bumps_version_after_commit(self):
+        version = School.objects.get(pk=self.school.pk).karma_version
+        with self.captureOnCommitCallbacks(execute=True):
+            Karma.apply_delta(self.student, 15)
+            self.assertEqual(School.objects.get(pk=self.school.pk).karma_version, version)
+        self.assertEqual(School.objects.get(pk=self.school.pk).karma_version, version + 1)
+
+    def test_deltas_match_full_recomputation(self):
+        review = Review.objects.create(staff=self.staff, student=self.student, text='This is a test review that is at least fifty characters.', rating=2, is_good=False)
+        Karma.apply_delta(self.student, Karma.review_delta(review.is_good))
+        Vote.objects.create(staff=self.staff, review=review, value="DOWN")
+        Karma.apply_delta(self.student, Karma.vote_delta(review.is_good, None, "DOWN"))
+        Endorsement.objects.create(leadership=True, student=self.student, staff=self.staff)
+        Karma.apply_delta(self.student, Karma.endorsement_delta(True))
+        self.karma.refresh_from_db()
+        self.assertEqual(self.karma.score, 100 - 50 + 5 + 10)
+        self.assertEqual(self.karma.score, self.karma.calculate_score())
+
+    def test_update_score(self):
+        Karma.apply_delta(self.student, 30)
+        self.karma.refresh_from_db()
+        self.karma.update_score()
+        self.assertEqual(self.karma.score, 100)
+
+    def test_school_copied_from_student(self):
+        self.assertEqual(self.karma.school, self.school)
+
+    def test_standing(self):
+        for name, score in [('Amy', 150), ('Ben', 100), ('Cal', 90)]:
+            Karma.objects.create(student=Student.objects.create(name=name, school=self.school), score=score)
+        other_school = School.objects.create(name='PRES')
+        Karma.objects.create(student=Student.objects.create(name='Dan', school=other_school), score=500)
+        self.assertEqual(self.karma.standing(), {'rank': 2, 'total': 4, 'percentile': 75})
+
+    def test_verify_counters_fix(self):
+        Karma.apply_delta(self.student, 30)
+        out = io.StringIO()
+        call_command('verify_counters', stdout=out)
+        self.assertIn('Found 1 mismatched', out.getvalue())
+        call_command('verify_counters', '--fix', stdout=out)
+        self.karma.refresh_from_db()
+        self.assertEqual(self.karma.score, 100)
+
 #
 #   STAFFINBOX MODEL TESTS
 #
@@ -376,3 +620,379 @@ class ActivityModelTestCase(TestCase):
         self.assertTrue(self.activity.created_at)
 
 
+
+
+#
+#   STUDENT SUMMARY MODEL TESTS
+#
+class StudentSummaryModelTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.school = School.objects.create(name='ASJA')
+        self.user = User.objects.create_user(
+            username='asja',
+            email='asja@gmail.com',
+            password='testpassword',
+            first_name='Test',
+            last_name='User'
+        )
+        self.staff = Staff.objects.create(user=self.user, school=self.school)
+        self.student = Student.objects.create(name='Jane Doe', school=self.school)
+        self.review = Review.objects.create(staff=self.staff, student=self.student, text='This is a test review that is at least fifty characters.', rating=3, is_good=True)
+
+    def test_no_reviews(self):
+        other = Student.objects.create(name='John Doe', school=self.school)
+        with mock.patch('base.summaries.complete') as complete:
+            self.assertIsNone(get_summary(other))
+        complete.assert_not_called()
+
+    def test_summary_reused_until_reviews_change(self):
+        with mock.patch('base.summaries.complete', return_value='Jane is great') as complete:
+            self.assertEqual(get_summary(self.student), 'Jane is great')
+            self.assertEqual(get_summary(self.student), 'Jane is great')
+            self.assertEqual(complete.call_count, 1)
+
+            self.review.text = 'This is an edited test review that is at least fifty characters.'
+            self.review.save()
+            get_summary(self.student)
+            self.assertEqual(complete.call_count, 2)
+
+            self.review.delete()
+            self.assertIsNone(get_summary(self.student))
+        self.assertEqual(StudentSummary.objects.get(student=self.student, kind='PROFILE').text, 'Jane is great')
+
+    def test_summary_kinds(self):
+        Review.objects.create(staff=self.staff, student=self.student, text='This is a negative test review that is at least fifty characters.', rating=1, is_good=False)
+        with mock.patch('base.summaries.complete', side_effect=['profile', 'letter']) as complete:
+            self.assertEqual(get_summary(self.student, 'PROFILE'), 'profile')
+            self.assertEqual(get_summary(self.student, 'LETTER'), 'letter')
+        self.assertNotIn('negative', complete.call_args_list[1][0][0]) # letters only use positive reviews
+
+    def test_summary_unavailable(self):
+        with mock.patch('base.summaries.complete', side_effect=LLMUnavailable('unavailable')):
+            self.assertIsNone(get_summary(self.student))
+        StudentSummary.objects.create(student=self.student, kind='PROFILE', input_hash='stale', text='Last summary')
+        with mock.patch('base.summaries.complete', side_effect=LLMUnavailable('unavailable')):
+            self.assertEqual(get_summary(self.student), 'Last summary')
+
+
+#
+#   SINGLE-FLIGHT TESTS
+#
+class SingleFlightTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_calls_share_one_call(self):
+        calls = []
+        def generate():
+            calls.append(1)
+            time.sleep(0.3)
+            return 'summary'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight('test', generate))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['summary'] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_call_is_retried(self):
+        with self.assertRaises(ValueError):
+            single_flight('test', mock.Mock(side_effect=ValueError))
+        self.assertEqual(single_flight('test', lambda: 'summary'), 'summary')
+
+    def test_wait_timeout(self):
+        cache.add('single-flight-lock:test', True)
+        with self.assertRaises(SingleFlightTimeout):
+            single_flight('test', lambda: 'summary', wait_timeout=0.2)
+
+    def test_letter_prompts_coalesce(self):
+        with mock.patch('base.summaries.complete', return_value='Dear reader') as complete:
+            self.assertEqual(generate_letter('Write a letter'), 'Dear reader')
+            self.assertEqual(generate_letter('Write a letter'), 'Dear reader')
+            self.assertEqual(generate_letter('Write another letter'), 'Dear reader')
+        self.assertEqual(complete.call_count, 2)
+
+
+#
+#   LLM BACKEND TESTS
+#
+class LLMBackendTest(TestCase):
+    def test_stub_output_is_deterministic(self):
+        backend = StubBackend()
+        self.assertEqual(backend.complete('Summarize this'), backend.complete('Summarize this'))
+        self.assertNotEqual(backend.complete('Summarize this'), backend.complete('Summarize that'))
+
+    def test_stub_failures(self):
+        with self.assertRaises(LLMError):
+            StubBackend(failure_rate=1).complete('Summarize this')
+        backend = StubBackend(failure_rate=0.5, seed=1)
+        failures = 0
+        for i in range(100):
+            try:
+                backend.complete('Summarize this')
+            except LLMError:
+                failures += 1
+        self.assertTrue(20 < failures < 80)
+
+    @override_settings(LLM_BACKEND='stub', LLM_STUB_LATENCY=0, LLM_STUB_FAILURE_RATE=0)
+    def test_backend_from_settings(self):
+        self.assertIsInstance(get_backend(), StubBackend)
+        self.assertIs(get_backend(), get_backend())
+        with override_settings(LLM_BACKEND='openai', OPENAI_API_KEY='key'):
+            self.assertIsInstance(get_backend(), OpenAIBackend)
+        with override_settings(LLM_BACKEND='other'):
+            with self.assertRaises(ImproperlyConfigured):
+                get_backend()
+
+
+@override_settings(LLM_BACKEND='stub', LLM_STUB_LATENCY=0, LLM_STUB_FAILURE_RATE=0, LLM_TIMEOUT=0.5, LLM_RETRIES=2, LLM_RETRY_BACKOFF=0, LLM_BREAKER_THRESHOLD=3, LLM_BREAKER_RESET_TIMEOUT=30)
+class LLMCompleteTest(TestCase):
+    def setUp(self):
+        create_breaker.cache_clear()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_complete(self):
+        self.assertEqual(complete('Summarize this'), StubBackend().complete('Summarize this'))
+
+    def test_retries(self):
+        backend = StubBackend()
+        with mock.patch.object(backend, 'complete', side_effect=[LLMError('busy'), LLMError('busy'), 'text']) as backend_complete:
+            with mock.patch('base.llm.get_backend', return_value=backend):
+                self.assertEqual(complete('Summarize this'), 'text')
+        self.assertEqual(backend_complete.call_count, 3)
+        self.assertFalse(get_breaker().is_open)
+
+    def test_no_retry_for_rejected_requests(self):
+        backend = StubBackend()
+        with mock.patch.object(backend, 'complete', side_effect=LLMError('invalid request', retryable=False)) as backend_complete:
+            with mock.patch('base.llm.get_backend', return_value=backend):
+                with self.assertRaises(LLMUnavailable):
+                    complete('Summarize this')
+        self.assertEqual(backend_complete.call_count, 1)
+
+    def test_unexpected_error_ends_half_open_trial(self):
+        breaker = get_breaker()
+        for i in range(3):
+            breaker.record_failure()
+        breaker.opened_at -= 30  # the reset timeout has passed, the next call is the trial
+        backend = StubBackend()
+        with mock.patch.object(backend, 'complete', side_effect=RuntimeError('bug')):
+            with mock.patch('base.llm.get_backend', return_value=backend), self.assertLogs('base.llm', 'ERROR'):
+                with self.assertRaises(LLMUnavailable) as raised:
+                    complete('Summarize this')
+        self.assertEqual(raised.exception.outcome, 'error')
+        self.assertFalse(breaker.trial_running)
+        breaker.opened_at -= 30
+        self.assertEqual(complete('Summarize this'), StubBackend().complete('Summarize this'))  # a new trial closes it
+        self.assertFalse(breaker.is_open)
+
+    def test_openai_empty_response(self):
+        with mock.patch('base.llm.openai.Completion.create', return_value=mock.Mock(choices=[])):
+            with self.assertRaises(LLMError):
+                OpenAIBackend('key', 'model').complete('Summarize this')
+
+    @override_settings(LLM_STUB_LATENCY=5, LLM_TIMEOUT=0.1, LLM_RETRIES=0)
+    def test_timeout(self):
+        start = time.monotonic()
+        with self.assertRaises(LLMUnavailable):
+            complete('Summarize this')
+        self.assertLess(time.monotonic() - start, 1)
+
+    @override_settings(LLM_STUB_LATENCY=5, LLM_TIMEOUT=10, LLM_RETRIES=5)
+    def test_deadline(self):
+        # each attempt only gets the time left, and no attempt is made past the deadline
+        start = time.monotonic()
+        with self.assertRaises(LLMUnavailable) as raised:
+            complete('Summarize this', deadline=start + 0.2)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(raised.exception.outcome, 'timeout')
+
+    @override_settings(LLM_RETRY_BACKOFF=10)
+    def test_no_retry_past_deadline(self):
+        backend = StubBackend()
+        with mock.patch.object(backend, 'complete', side_effect=LLMError('busy')) as backend_complete:
+            with mock.patch('base.llm.get_backend', return_value=backend):
+                with self.assertRaises(LLMUnavailable):
+                    complete('Summarize this', deadline=time.monotonic() + 1)
+        self.assertEqual(backend_complete.call_count, 1)  # the backoff would end after the deadline
+
+    def test_no_retries(self):
+        backend = StubBackend()
+        with mock.patch.object(backend, 'complete', side_effect=LLMError('busy')) as backend_complete:
+            with mock.patch('base.llm.get_backend', return_value=backend):
+                with self.assertRaises(LLMUnavailable):
+                    complete('Summarize this', retries=0)
+        self.assertEqual(backend_complete.call_count, 1)
+
+    @override_settings(LLM_STUB_FAILURE_RATE=1)
+    def test_circuit_breaker_opens(self):
+        with self.assertRaises(LLMUnavailable):
+            complete('Summarize this')  # 3 failed attempts open the circuit
+        self.assertTrue(get_breaker().is_open)
+        with mock.patch('base.llm.StubBackend.complete') as backend_complete:
+            with self.assertRaises(LLMUnavailable):
+                complete('Summarize this')
+        backend_complete.assert_not_called()  # fails fast while open
+
+    def test_circuit_breaker_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.1)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())  # one trial call
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+
+#
+#   PROMPT BUILDER TESTS
+#
+@override_settings(LLM_INPUT_TOKEN_BUDGET=100, LLM_CONTEXT_TOKENS=4097)
+class PromptBuilderTest(TestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(''), 0)
+        self.assertEqual(estimate_tokens('abcd'), 1)
+        self.assertEqual(estimate_tokens('abcde'), 2)
+
+    def test_pack_texts(self):
+        packed = pack_texts(['a' * 200, 'a' * 200, 'b' * 400], 100)
+        self.assertEqual(len(packed), 2)                  # the repeated text is dropped
+        self.assertEqual(packed[0], 'a' * 200)            # 50 tokens
+        self.assertTrue(packed[1].endswith('...'))        # cut short to the 50 tokens left
+        self.assertLessEqual(sum(estimate_tokens(text) for text in packed), 100)
+
+        packed = pack_texts(['a' * 360, 'b' * 400, 'c  d ' * 8], 100)
+        self.assertEqual(packed, ['a' * 360, 'c d ' * 7 + 'c d'])  # a shorter text fills what is left
+
+    def test_summary_prompt_fits_budget(self):
+        texts = ['This is a test review that is at least fifty characters. ' * 20] * 10
+        prompt, max_tokens = summary_prompt(texts)
+        self.assertLessEqual(estimate_tokens(prompt), 110)
+        self.assertEqual(max_tokens, 64)  # short input, short summary
+
+    @override_settings(LLM_INPUT_TOKEN_BUDGET=5000)
+    def test_summary_max_tokens(self):
+        prompt, max_tokens = summary_prompt(['word ' * 2000])
+        self.assertEqual(max_tokens, SUMMARY_MAX_TOKENS)
+        prompt, max_tokens = summary_prompt(['word ' * 3960])
+        self.assertEqual(max_tokens, 1)  # capped by what the context has left
+
+
+
+#
+#   LLM METRICS TESTS
+#
+@override_settings(LLM_BACKEND='stub', LLM_STUB_LATENCY=0, LLM_STUB_FAILURE_RATE=0, LLM_TIMEOUT=0.5, LLM_RETRIES=2, LLM_RETRY_BACKOFF=0, LLM_BREAKER_THRESHOLD=3, LLM_BREAKER_RESET_TIMEOUT=30)
+class LLMMetricsTest(TestCase):
+    def setUp(self):
+        create_breaker.cache_clear()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_calls_are_recorded(self):
+        complete('Summarize this', operation='profile_summary')
+        with override_settings(LLM_STUB_FAILURE_RATE=1, LLM_RETRIES=0):
+            with self.assertRaises(LLMUnavailable):
+                complete('Summarize this', operation='profile_summary')
+        snapshot = metrics.snapshot()['profile_summary']
+        self.assertEqual(snapshot['calls'], 2)
+        self.assertEqual(snapshot['outcomes'], {'success': 1, 'timeout': 0, 'error': 1, 'unavailable': 0})
+        self.assertEqual(snapshot['input_tokens'], 8)
+        self.assertIsNotNone(snapshot['latency']['p99'])
+
+        metrics.flush()
+        self.assertEqual(list(LLMCall.objects.order_by('id').values_list('outcome', 'attempts')), [('success', 1), ('error', 1)])
+        out = io.StringIO()
+        call_command('llm_metrics', stdout=out)
+        self.assertIn('profile_summary: 2 call(s)', out.getvalue())
+        self.assertIn('success 1  timeout 0  error 1  unavailable 0', out.getvalue())
+
+    @override_settings(LLM_STUB_LATENCY=5, LLM_TIMEOUT=0.05, LLM_RETRIES=0)
+    def test_timeouts_are_recorded(self):
+        with self.assertRaises(LLMUnavailable):
+            complete('Summarize this', operation='letter')
+        self.assertEqual(metrics.snapshot()['letter']['outcomes']['timeout'], 1)
+
+    def test_cache_hit_rate(self):
+        metrics.cache_lookup('profile_summary', hit=True)
+        metrics.cache_lookup('profile_summary', hit=True)
+        metrics.cache_lookup('profile_summary', hit=False)
+        self.assertAlmostEqual(metrics.snapshot()['profile_summary']['cache_hit_rate'], 2 / 3)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 90), 3)
+        self.assertIsNone(percentile([], 50))
+
+
+
+#
+#   KEYSET PAGINATION TESTS
+#
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='asja', email='asja@gmail.com', password='testpassword')
+        self.activities = [Activity.objects.create(user=self.user, message=f'Activity {i}', parameter='NA') for i in range(7)]
+        # some activities at the same time, they are ordered by id
+        same_time = timezone.now()
+        Activity.objects.filter(pk__in=[a.pk for a in self.activities[2:5]]).update(created_at=same_time)
+        self.recent_first = list(Activity.objects.order_by('-created_at', '-id'))
+        self.paginator = KeysetPaginator(Activity.objects.filter(user=self.user), per_page=3)
+
+    def test_pages_forward_and_back(self):
+        first = self.paginator.page()
+        self.assertEqual(list(first), self.recent_first[:3])
+        self.assertFalse(first.has_previous())
+        self.assertTrue(first.has_next())
+
+        second = self.paginator.page(first.next_cursor)
+        self.assertEqual(list(second), self.recent_first[3:6])
+        self.assertTrue(second.has_previous())
+
+        last = self.paginator.page(second.next_cursor)
+        self.assertEqual(list(last), self.recent_first[6:])
+        self.assertFalse(last.has_next())
+        self.assertIsNone(last.next_cursor)
+
+        back = self.paginator.page(last.previous_cursor)
+        self.assertEqual(list(back), self.recent_first[3:6])
+        self.assertTrue(back.has_next())
+        back = self.paginator.page(back.previous_cursor)
+        self.assertEqual(list(back), self.recent_first[:3])
+        self.assertFalse(back.has_previous())
+
+    def test_invalid_cursor(self):
+        for cursor in ['', 'not-a-cursor', 'W3RydWUsWyJ4IiwxXV0']:
+            self.assertEqual(list(self.paginator.page(cursor)), self.recent_first[:3])
+
+    def test_mixed_ordering(self):
+        paginator = KeysetPaginator(Activity.objects.all(), per_page=2, ordering=('message', '-created_at', '-id'))
+        page = paginator.page()
+        names = [a.message for a in page]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            names += [a.message for a in page]
+        self.assertEqual(names, sorted(a.message for a in self.activities))
+        self.assertEqual(paginator.count, 7)
+
+    def test_page_query_count(self):
+        cursor = self.paginator.page().next_cursor
+        with self.assertNumQueries(1):
+            self.paginator.page(cursor)
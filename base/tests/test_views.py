@@ -1,13 +1,28 @@
 import json
-from django.test import TestCase, Client, RequestFactory
+import os
+import io
+import shutil
+import tempfile
+import time
+from unittest import mock
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User, Group, AnonymousUser
 from django.contrib import messages
 from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
 from datetime import datetime
-from base.models import School, Admin, Staff, Student
+from base.models import School, Admin, Staff, Student, LeaderboardExport, ImportJob, StudentSummary
+from base.llm import LLMUnavailable
+from base.metrics import metrics
 from base.forms import StaffRegistrationForm
 from base.views import *
+from base.roster import ImportResult, ChunkReader, read_roster, import_students, import_batch
+from base.exports import render_leaderboard_export
+from base import tasks
+from django.core.management import call_command
+from django.core.cache import cache
 
 
 class LoginViewTests(TestCase):
@@ -132,6 +147,19 @@ class StaffHomeViewTests(TestCase):
         #print(response.context)
         self.assertQuerysetEqual(response.context['activities'], self.expected_activity)
 
+    def test_staff_home_pages(self):
+        for i in range(6):
+            Activity.objects.create(user=self.user, message=f"Message {i}", parameter="NA")
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        response = client.get(reverse('base:staff-home'))
+        self.assertEqual(len(response.context['activities']), 5)
+        self.assertContains(response, f'href="?cursor={response.context["activities"].next_cursor}"')
+        with override_settings(NUMBERED_PAGES=True):
+            response = client.get(reverse('base:staff-home'), {'page': '2'})
+        self.assertEqual(len(response.context['activities']), 2)
+        self.assertContains(response, 'href="?page=1"')
+
 
 class StaffSearchViewTests(TestCase):
     def setUp(self):
@@ -224,6 +252,13 @@ class StudentProfileViewTests(TestCase):
         self.assertEqual(response.context['endorsement_stats'], self.endorsement_stats)
         self.assertEqual(response.context['reviews'][0][0], self.review)
 
+    def test_student_profile_percentile(self):
+        for name in ('Amy', 'Ben'):
+            Karma.objects.create(student=Student.objects.create(name=name, school=self.school), score=500)
+        self.client.login(username='presstaff', password='testpassword')
+        response = self.client.get(reverse('base:student-profile', kwargs={'student_name': self.student.name}))
+        self.assertContains(response, 'Rank 3 of 3 &middot; 33rd percentile')
+
 
 class ReviewViewTests(TestCase):
     def setUp(self):
@@ -393,6 +428,622 @@ class ReviewViewTests(TestCase):
         self.assertEqual(review.stats.upvotes, 0)
         self.assertEqual(review.stats.downvotes, 1)
 
+    def test_review_and_vote_update_karma(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        client.post(reverse('base:write-review', kwargs={'student_name':self.student.name}), self.form_data)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 150)
+        review = Review.objects.get(student=self.student)
+        client.post(reverse('base:vote-review', kwargs={'review_id':review.id, 'vote_value':'UP'}))
+        self.assertEqual(Karma.objects.get(student=self.student).score, 155)
+        client.post(reverse('base:vote-review', kwargs={'review_id':review.id, 'vote_value':'DOWN'}))
+        self.assertEqual(Karma.objects.get(student=self.student).score, 145)
+        self.form_data['rating'] = '1'
+        client.post(reverse('base:edit-review', kwargs={'review_id':review.id}), self.form_data)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 55)
+        client.post(reverse('base:delete-review', kwargs={'review_id':review.id}))
+        self.assertEqual(Karma.objects.get(student=self.student).score, 100)
+
+    def test_edit_review_flip_applied_once(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        client.post(reverse('base:write-review', kwargs={'student_name':self.student.name}), self.form_data)
+        review = Review.objects.get(student=self.student)
+        stale = Review.objects.get(pk=review.pk)
+        # another edit made the review bad after this request had loaded it
+        self.form_data['rating'] = '1'
+        client.post(reverse('base:edit-review', kwargs={'review_id':review.id}), self.form_data)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 50)
+        with mock.patch('base.views.get_object_or_404', return_value=stale):
+            client.post(reverse('base:edit-review', kwargs={'review_id':review.id}), self.form_data)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 50)
+
+    def test_vote_review_get_and_invalid_value(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+        Stats.objects.create(review=review)
+        response = client.get(reverse('base:vote-review', kwargs={'review_id':review.id, 'vote_value':'UP'}))
+        self.assertRedirects(response, reverse('base:student-profile', kwargs={'student_name':self.student.name}), fetch_redirect_response=False)
+        self.assertFalse(Vote.objects.exists())
+        response = client.post(reverse('base:vote-review', kwargs={'review_id':review.id, 'vote_value':'SIDEWAYS'}))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_vote_review_json(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+        Stats.objects.create(review=review)
+        url = reverse('base:vote-review-json', kwargs={'review_id':review.id, 'vote_value':'UP'})
+        response = client.post(url)
+        self.assertEqual(response.json(), {'review': review.id, 'vote': 'UP', 'upvotes': 1, 'downvotes': 0, 'net_votes': 1, 'karma': 105})
+        response = client.post(reverse('base:vote-review-json', kwargs={'review_id':review.id, 'vote_value':'DOWN'}))
+        self.assertEqual(response.json(), {'review': review.id, 'vote': 'DOWN', 'upvotes': 0, 'downvotes': 1, 'net_votes': -1, 'karma': 95})
+        self.assertEqual(Activity.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(client.get(url).status_code, 405)
+
+    def test_vote_review_json_other_school(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        other_school = School.objects.create(name="Other College")
+        other_student = Student.objects.create(name="John Doe", school=other_school)
+        review = Review.objects.create(staff=self.staff, student=other_student, text=self.text, rating=3, is_good=True)
+        response = client.post(reverse('base:vote-review-json', kwargs={'review_id':review.id, 'vote_value':'UP'}))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_give_endorsement_json(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        url = reverse('base:endorse-json', kwargs={'student_name':self.student.name, 'skill':'teamwork'})
+        response = client.post(url)
+        self.assertEqual(response.json(), {'skill': 'teamwork', 'endorsed': True, 'count': 1, 'karma': 110})
+        response = client.post(url)
+        self.assertEqual(response.json(), {'skill': 'teamwork', 'endorsed': False, 'count': 0, 'karma': 100})
+        response = client.post(reverse('base:endorse-json', kwargs={'student_name':self.student.name, 'skill':'charisma'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_give_endorsement_updates_counters(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        client.post(reverse('base:endorse', kwargs={'student_name':self.student.name, 'skill':'punctuality'}))
+        self.endorsement_stats.refresh_from_db()
+        self.assertEqual(self.endorsement_stats.punctuality, 1)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 110)
+        client.post(reverse('base:endorse', kwargs={'student_name':self.student.name, 'skill':'punctuality'}))
+        self.endorsement_stats.refresh_from_db()
+        self.assertEqual(self.endorsement_stats.punctuality, 0)
+        self.assertEqual(Karma.objects.get(student=self.student).score, 100)
+
+
+    def test_student_reviews_votes(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        reviews = []
+        for i in range(12):
+            review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+            Stats.objects.create(review=review)
+            reviews.append(review)
+        Vote.objects.create(staff=self.staff, review=reviews[-1], value="UP")
+        Vote.objects.create(staff=self.staff, review=reviews[-2], value="DOWN")
+
+        response = client.get(reverse('base:student-reviews', kwargs={'student_name': self.student.name}))
+        listing = list(response.context['reviews'])
+        self.assertEqual(len(listing), 8)
+        self.assertEqual(listing[0], (reviews[-1], "UP"))
+        self.assertEqual(listing[1], (reviews[-2], "DOWN"))
+        self.assertEqual(listing[2], (reviews[-3], None))
+
+        response = client.get(reverse('base:student-profile', kwargs={'student_name': self.student.name}))
+        self.assertEqual(response.context['reviews'][:2], [(reviews[-1], "UP"), (reviews[-2], "DOWN")])
+
+    def test_student_reviews_orders(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        reviews = {}
+        for name, rating, upvotes, downvotes in [('old', 3, 5, 1), ('mid', 5, 2, 2), ('new', 1, 0, 3), ('top', 4, 9, 0)]:
+            reviews[name] = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=rating, is_good=rating >= 3)
+            Stats.objects.create(review=reviews[name], upvotes=upvotes, downvotes=downvotes)
+        url = reverse('base:student-reviews', kwargs={'student_name': self.student.name})
+
+        expected = {
+            'MostHelpful': ['top', 'old', 'mid', 'new'],
+            'HighestRating': ['mid', 'top', 'old', 'new'],
+            'LowestRating': ['new', 'old', 'top', 'mid'],
+            '': ['top', 'new', 'mid', 'old'],
+        }
+        for order, names in expected.items():
+            response = client.get(url, {'order': order})
+            self.assertEqual([review for review, voted in response.context['reviews']], [reviews[name] for name in names], order)
+
+        # the number of queries doesn't depend on the number of reviews
+        with self.assertNumQueries(10):
+            client.get(url, {'order': 'MostHelpful'})
+
+    def test_student_reviews_cursor(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        for i in range(10):
+            review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+            Stats.objects.create(review=review, upvotes=i % 3)
+        expected = list(Review.annotate_helpfulness(Review.objects.all()).order_by('-helpfulness', '-created_at', '-id'))
+        url = reverse('base:student-reviews', kwargs={'student_name': self.student.name})
+
+        first = client.get(url, {'order': 'MostHelpful'}).context['reviews']
+        self.assertTrue(first.has_next())
+        second = client.get(url, {'order': 'MostHelpful', 'cursor': first.next_cursor}).context['reviews']
+        self.assertFalse(second.has_next())
+        self.assertEqual([review for review, voted in list(first) + list(second)], expected)
+        response = client.get(url, {'order': 'MostHelpful', 'cursor': second.previous_cursor})
+        self.assertEqual([review for review, voted in response.context['reviews']], expected[:8])
+        self.assertContains(response, 'Showing 8 of 10 review(s)')
+
+    @override_settings(NUMBERED_PAGES=True)
+    def test_student_reviews_numbered(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        for i in range(10):
+            review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+            Stats.objects.create(review=review, upvotes=i % 3)
+        expected = list(Review.annotate_helpfulness(Review.objects.all()).order_by('-helpfulness', '-created_at', '-id'))
+        url = reverse('base:student-reviews', kwargs={'student_name': self.student.name})
+
+        response = client.get(url, {'order': 'MostHelpful', 'page': '2'})
+        reviews = response.context['reviews']
+        self.assertEqual((reviews.number, reviews.paginator.num_pages), (2, 2))
+        self.assertEqual([review for review, voted in reviews], expected[8:])
+        self.assertContains(response, 'href="?page=1&order=MostHelpful"')
+        self.assertContains(response, 'Showing 2 of 10 review(s)')
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_review_refreshes_summary(self):
+        cache.clear()
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        profile_url = reverse('base:student-profile', kwargs={'student_name': self.student.name})
+        with mock.patch('base.summaries.complete', return_value='Jane is a great student') as complete:
+            response = client.get(profile_url)
+            self.assertEqual(response.context['summary'], "There's not much on this student...")
+            with self.captureOnCommitCallbacks(execute=True):
+                client.post(reverse('base:write-review', kwargs={'student_name':self.student.name}), self.form_data)
+            self.assertEqual(complete.call_count, 1) # the profile summary, letter summaries are refreshed by letters
+
+            response = client.get(profile_url)
+            self.assertEqual(response.context['summary'], 'Jane is a great student')
+            self.assertEqual(complete.call_count, 1)
+            self.assertFalse(StudentSummary.objects.filter(student=self.student, kind='LETTER').exists())
+
+    def test_profile_refreshes_stale_summary(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+        Stats.objects.create(review=review)
+        StudentSummary.objects.create(student=self.student, kind='PROFILE', input_hash='stale', text='Jane was great')
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = client.get(reverse('base:student-profile', kwargs={'student_name': self.student.name}))
+        self.assertEqual(response.context['summary'], 'Jane was great')
+        self.assertEqual(len(callbacks), 1)  # eg. the refresh queued by the review failed, it is queued again
+
+    def test_profile_never_waits_for_summary(self):
+        client = Client()
+        client.login(username='presstaff', password='testpassword')
+        review = Review.objects.create(staff=self.staff, student=self.student, text=self.text, rating=3, is_good=True)
+        Stats.objects.create(review=review)
+        with mock.patch('base.summaries.complete') as complete:
+            response = client.get(reverse('base:student-profile', kwargs={'student_name': self.student.name}))
+        complete.assert_not_called()
+        self.assertEqual(response.context['summary'], 'The summary for this student is being generated, check back soon!')
+
+
+class LeaderboardViewTests(TestCase):
+    def setUp(self):
+        self.staff_group = Group.objects.create(name='STAFF')
+        self.school = School.objects.create(name="Presentation College")
+        self.user = User.objects.create_user(
+            email='presstaff@gmail.com',
+            username = 'presstaff',
+            first_name = 'Test',
+            last_name = 'User',
+            password = 'testpassword'
+        )
+        self.staff = Staff.objects.create(user=self.user, school=self.school)
+        self.user.groups.add(self.staff_group)
+        for name, score in [('Amy', 150), ('Ben', 200), ('Cal', 150), ('Dan', 90), ('Eve', 100)]:
+            student = Student.objects.create(name=name, school=self.school)
+            Karma.objects.create(student=student, score=score)
+        other_school = School.objects.create(name="Naparima College")
+        Karma.objects.create(student=Student.objects.create(name='Zed', school=other_school), score=500)
+        cache.clear()
+        self.client.login(username='presstaff', password='testpassword')
+
+    def test_leaderboard_ranks(self):
+        response = self.client.get(reverse('base:leaderboard'))
+        self.assertEqual(response.status_code, 200)
+        ranking = [(student.name, student.rank) for student in response.context['students']]
+        self.assertEqual(ranking, [('Ben', 1), ('Amy', 2), ('Cal', 2), ('Eve', 4), ('Dan', 5)])
+        self.assertEqual(response.context['school_total'], 5)
+
+    def test_leaderboard_top_query(self):
+        response = self.client.get(reverse('base:leaderboard'), {'query': '2'})
+        ranking = [(student.name, student.rank) for student in response.context['students']]
+        self.assertEqual(ranking, [('Ben', 1), ('Amy', 2), ('Cal', 2)])
+        self.assertEqual(response.context['query'], 2)
+
+    def test_leaderboard_invalid_query(self):
+        response = self.client.get(reverse('base:leaderboard'), {'query': '9'})
+        self.assertEqual(response.context['query'], 0)
+        self.assertEqual(len(response.context['students']), 5)
+
+    def test_student_standing(self):
+        response = self.client.get(reverse('base:student-standing', kwargs={'student_name': 'Cal'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'rank': 2, 'total': 5, 'percentile': 80, 'score': 150})
+
+    def test_student_standing_other_school(self):
+        response = self.client.get(reverse('base:student-standing', kwargs={'student_name': 'Zed'}))
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_leaderboard_download(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(reverse('base:leaderboard'), {'download': 'download', 'query': '2'})
+        export = LeaderboardExport.objects.get()
+        self.assertRedirects(response, reverse('base:leaderboard-export', kwargs={'export_id': export.id}))
+        self.assertEqual(export.top, 2)
+        self.assertEqual(export.status, 'DONE')
+        response = self.client.get(reverse('base:leaderboard-export-status', kwargs={'export_id': export.id}))
+        self.assertEqual(response.json()['status'], 'DONE')
+        response = self.client.get(reverse('base:leaderboard-export-download', kwargs={'export_id': export.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="Presentation College_student_leaderboard_top2.pdf"')
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_leaderboard_download_reused_until_karma_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('base:leaderboard'), {'download': 'download'})
+            self.client.get(reverse('base:leaderboard'), {'download': 'download'})
+        self.assertEqual(LeaderboardExport.objects.count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Karma.apply_delta(Student.objects.get(name='Dan'), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('base:leaderboard'), {'download': 'download'})
+        version = School.objects.get(pk=self.school.pk).karma_version
+        self.assertEqual(LeaderboardExport.objects.filter(karma_version=version).count(), 1)
+        self.assertEqual(LeaderboardExport.objects.count(), 2)  # the old one can still be downloaded
+
+        # finished exports of older versions are deleted once their retention has passed
+        LeaderboardExport.objects.update(finished_at=timezone.now() - timezone.timedelta(hours=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            Karma.apply_delta(Student.objects.get(name='Dan'), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('base:leaderboard'), {'download': 'download'})
+        self.assertEqual(LeaderboardExport.objects.get().karma_version, version + 1)
+
+    def test_leaderboard_export_in_progress_is_kept(self):
+        export = LeaderboardExport.objects.create(school=self.school, karma_version=0, status='RUNNING', started_at=timezone.now())
+        School.objects.filter(pk=self.school.pk).update(karma_version=1)
+        self.client.get(reverse('base:leaderboard'), {'download': 'download'})
+        self.assertTrue(LeaderboardExport.objects.filter(pk=export.pk).exists())
+        response = self.client.get(reverse('base:leaderboard-export-status', kwargs={'export_id': export.id}))
+        self.assertEqual(response.json()['status'], 'RUNNING')
+
+    def test_leaderboard_export_status_missing(self):
+        response = self.client.get(reverse('base:leaderboard-export-status', kwargs={'export_id': 99}))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'status': 'MISSING', 'download_url': None})
+
+    def test_claim_export(self):
+        export = LeaderboardExport.objects.create(school=self.school, karma_version=0)
+        self.assertTrue(tasks.claim_job(LeaderboardExport, export.id))
+        self.assertEqual(LeaderboardExport.objects.get().status, 'RUNNING')
+        self.assertFalse(tasks.claim_job(LeaderboardExport, export.id))  # claimed by another worker
+        LeaderboardExport.objects.update(started_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertTrue(tasks.claim_job(LeaderboardExport, export.id))  # that worker died
+        LeaderboardExport.objects.update(status='DONE')
+        self.assertFalse(tasks.claim_job(LeaderboardExport, export.id))
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_claimed_export_is_not_rendered_twice(self):
+        export = LeaderboardExport.objects.create(school=self.school, karma_version=0, status='RUNNING', started_at=timezone.now())
+        render_leaderboard_export(export.id)
+        self.assertEqual(LeaderboardExport.objects.get().status, 'RUNNING')
+        self.assertIsNone(LeaderboardExport.objects.get().pdf)
+
+    @override_settings(BACKGROUND_TASKS_EAGER=True)
+    def test_run_jobs_renders_lost_exports(self):
+        LeaderboardExport.objects.create(school=self.school, karma_version=0)  # queued by a process that died
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Ran 1 job(s).', out.getvalue())
+        export = LeaderboardExport.objects.get()
+        self.assertEqual(export.status, 'DONE')
+        self.assertTrue(export.pdf)
+
+    def test_leaderboard_csv_stream(self):
+        EndorsementStats.objects.create(student=Student.objects.get(name='Ben'), leadership=2)
+        response = self.client.get(reverse('base:leaderboard-stream', kwargs={'file_format': 'csv'}), {'query': '2'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'rank,name,karma,leadership,respect,punctuality,participation,teamwork')
+        self.assertEqual(lines[1], '1,Ben,200,2,0,0,0,0')
+        self.assertEqual(len(lines), 4)
+
+    def test_leaderboard_ndjson_stream(self):
+        response = self.client.get(reverse('base:leaderboard-stream', kwargs={'file_format': 'ndjson'}))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[2]['name'], 'Cal')
+        self.assertEqual(rows[2]['rank'], 2)
+
+    def test_leaderboard_stream_invalid_query(self):
+        for query in ('-1', '0', '6', 'ten'):
+            response = self.client.get(reverse('base:leaderboard-stream', kwargs={'file_format': 'csv'}), {'query': query})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.content, b'Enter a number between 1 and 5')
+        response = self.client.get(reverse('base:leaderboard-stream', kwargs={'file_format': 'csv'}), {'query': '5'})
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 6)
+
+    def test_leaderboard_stream_unknown_format(self):
+        response = self.client.get(reverse('base:leaderboard-stream', kwargs={'file_format': 'xml'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_leaderboard_bounded_queries(self):
+        # session, user, groups, staff and school, karma version, ranking
+        with self.assertNumQueries(6):
+            self.client.get(reverse('base:leaderboard'))
+        # every page and query variant is then served from the cached snapshot
+        with self.assertNumQueries(5):
+            self.client.get(reverse('base:leaderboard'), {'query': '2', 'page': '1'})
+
+    def test_leaderboard_snapshot_invalidated(self):
+        self.client.get(reverse('base:leaderboard'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Karma.apply_delta(Student.objects.get(name='Dan'), 100)
+        response = self.client.get(reverse('base:leaderboard'))
+        ranking = [(student.name, student.rank) for student in response.context['students']]
+        self.assertEqual(ranking[0], ('Ben', 1))
+        self.assertEqual(ranking[1], ('Dan', 2))
+
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(BACKGROUND_TASKS_EAGER=True, MEDIA_ROOT=MEDIA_ROOT)
+class UploadCsvViewTests(TestCase):
+    def setUp(self):
+        self.admin_group = Group.objects.create(name='ADMIN')
+        self.school = School.objects.create(name='Test School')
+        self.user = User.objects.create_user(
+            first_name = 'Test',
+            last_name = 'Admin',
+            username='admin',
+            email='admin@test.com',
+            password='password123',
+        )
+        self.user.groups.add(self.admin_group)
+        Admin.objects.create(user=self.user, school=self.school)
+        Student.objects.create(name='Existing Student', school=self.school)
+        self.client.login(username='admin', password='password123')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def upload(self, content):
+        csv_file = SimpleUploadedFile('students.csv', content, content_type='text/csv')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('base:student-upload'), {'csv_file': csv_file})
+        self.assertRedirects(response, reverse('base:admin-home'))
+        return ImportJob.objects.get(school=self.school)
+
+    def test_upload_csv(self):
+        job = self.upload(b'name\nNew Student\nExisting Student\nOther Student\nNew Student\n')
+        self.assertEqual(Student.objects.filter(school=self.school).count(), 3)
+        for name in ('New Student', 'Other Student'):
+            student = Student.objects.get(name=name, school=self.school)
+            self.assertEqual(student.karma.score, 100)
+            self.assertEqual(student.karma.school, self.school)
+            self.assertEqual(student.endorsementstats.leadership, 0)
+        self.assertEqual(job.status, 'DONE')
+        self.assertEqual((job.processed, job.inserted, job.skipped, job.error_count), (4, 2, 2, 0))
+        self.assertIsNotNone(job.finished_at)
+        self.assertFalse(job.csv_file) # the uploaded file is removed once imported
+
+        response = self.client.get(reverse('base:admin-home'))
+        self.assertContains(response, 'students.csv')
+        self.assertContains(response, reverse('base:import-job-status', args=[job.id]))
+
+    def test_upload_csv_batches(self):
+        names = [f'Student {i}' for i in range(25)]
+        self.assertEqual(import_students(self.school, names, batch_size=10), (25, 0))
+        self.assertEqual(Karma.objects.filter(school=self.school).count(), 25)
+        self.assertEqual(EndorsementStats.objects.filter(student__school=self.school).count(), 25)
+
+    def test_upload_csv_invalid_rows(self):
+        content = 'name\nGood Student\n\n  \n' + 'x' * 101 + '\nBad \xff Student\nOther Student\n'
+        job = self.upload(content.encode('latin-1'))
+        self.assertTrue(Student.objects.filter(name='Good Student', school=self.school).exists())
+        self.assertTrue(Student.objects.filter(name='Other Student', school=self.school).exists())
+        self.assertEqual(Student.objects.filter(school=self.school).count(), 3)
+        self.assertEqual(job.status, 'DONE')
+        self.assertEqual((job.inserted, job.error_count), (2, 3))
+        self.assertEqual(job.error_list, [
+            'Line 4: missing student name',
+            'Line 5: student name is longer than 100 characters',
+            'Line 6: student name is not valid UTF-8',
+        ])
+
+    def test_upload_csv_missing_column(self):
+        job = self.upload(b'student\nNew Student\n')
+        self.assertEqual(job.status, 'FAILED')
+        self.assertEqual(job.error_list, ['Line 1: The csv file must have a "name" column'])
+        self.assertEqual(Student.objects.filter(school=self.school).count(), 1)
+
+    def test_import_job_status(self):
+        job = self.upload(b'name\nNew Student\n')
+        response = self.client.get(reverse('base:import-job-status', args=[job.id]))
+        self.assertEqual(response.json(), {
+            'status': 'DONE', 'processed': 1, 'inserted': 1, 'skipped': 0, 'error_count': 0, 'errors': []
+        })
+
+        other_job = ImportJob.objects.create(school=School.objects.create(name='Other School'), filename='other.csv')
+        response = self.client.get(reverse('base:import-job-status', args=[other_job.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_run_jobs_imports_lost_uploads(self):
+        job = ImportJob(school=self.school, filename='students.csv')  # queued by a process that died
+        job.csv_file.save('students.csv', ContentFile(b'name\nNew Student\n'))
+        path = job.csv_file.path
+        call_command('run_jobs', '--once', stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.inserted), ('DONE', 1))
+        self.assertFalse(job.csv_file)
+        self.assertFalse(os.path.exists(path))
+        run_import_job(job.id)  # finished jobs are not run again
+        self.assertEqual(ImportJob.objects.get().inserted, 1)
+
+    def test_import_job_progress_is_a_heartbeat(self):
+        job = ImportJob(school=self.school, filename='students.csv')
+        job.csv_file.save('students.csv', ContentFile(b'name\nNew Student\n'))
+        claimed_again = []
+
+        def slow_import_batch(*args, **kwargs):
+            # the batch takes longer than BACKGROUND_JOB_TIMEOUT
+            ImportJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - timezone.timedelta(hours=1))
+            real_import_batch(*args, **kwargs)
+            claimed_again.append(tasks.claim_job(ImportJob, job.pk))
+
+        real_import_batch = import_batch
+        with mock.patch('base.roster.import_batch', slow_import_batch):
+            run_import_job(job.id)
+        self.assertEqual(claimed_again, [False])  # the progress saved after the batch shows the job is alive
+        self.assertEqual(ImportJob.objects.get().status, 'DONE')
+
+    def test_run_jobs_leaves_unreadable_uploads(self):
+        # stored by a web process on another machine
+        job = ImportJob.objects.create(school=self.school, csv_file='roster-imports/elsewhere.csv', filename='elsewhere.csv')
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Ran 0 job(s).', out.getvalue())
+        self.assertEqual(ImportJob.objects.get(pk=job.pk).status, 'PENDING')
+
+    def test_import_job_missing_file(self):
+        job = ImportJob.objects.create(school=self.school, csv_file='roster-imports/gone.csv', filename='gone.csv')
+        run_import_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'FAILED')
+        self.assertEqual(job.error_list, ['Line 1: the uploaded file could not be read, please upload it again'])
+        self.assertFalse(job.csv_file)
+
+    def test_upload_not_csv(self):
+        csv_file = SimpleUploadedFile('students.txt', b'name\nNew Student\n', content_type='text/plain')
+        self.client.post(reverse('base:student-upload'), {'csv_file': csv_file})
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_upload_csv_chunk_boundaries(self):
+        # multi-byte characters and rows split across chunks are decoded as a single stream
+        content = '\ufeffname\nZoë Student\nJosé Student\n'.encode('utf-8')
+        chunks = [content[i:i + 3] for i in range(0, len(content), 3)]
+        result = ImportResult()
+        stream = io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks)), encoding='utf-8-sig', newline='')
+        self.assertEqual(list(read_roster(stream, result)), ['Zoë Student', 'José Student'])
+        self.assertEqual(result.error_count, 0)
+
+
+@override_settings(LLM_BACKEND='stub', LLM_STUB_LATENCY=0, LLM_STUB_FAILURE_RATE=0, BACKGROUND_TASKS_EAGER=True)
+class RecommendationViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.staff_group = Group.objects.create(name='STAFF')
+        self.school = School.objects.create(name="Presentation College")
+        self.user = User.objects.create_user(
+            email='presstaff@gmail.com',
+            username = 'presstaff',
+            first_name = 'Test',
+            last_name = 'User',
+            password = 'testpassword'
+        )
+        self.staff = Staff.objects.create(user=self.user, school=self.school)
+        self.user.groups.add(self.staff_group)
+        self.student = Student.objects.create(name="Jane Doe", school=self.school)
+        Karma.objects.create(student=self.student, score=100)
+        EndorsementStats.objects.create(student=self.student)
+        self.review = Review.objects.create(staff=self.staff, student=self.student, text="This is a test review that is at least fifty characters.", rating=4, is_good=True)
+        self.client.login(username='presstaff', password='testpassword')
+        self.url = reverse('base:recommendation-letter', kwargs={'student_name': self.student.name})
+
+    def test_letter_generates_summary(self):
+        with mock.patch('base.summaries.complete', side_effect=['Jane is great', 'Dear reader']) as complete:
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['form'].initial['response'], 'Dear reader')
+        self.assertNotIn('message', response.context)
+        self.assertIn('Based on Jane is great', complete.call_args_list[1][0][0])
+        self.assertEqual(StudentSummary.objects.get(student=self.student, kind='LETTER').text, 'Jane is great')
+
+    @override_settings(LLM_REQUEST_DEADLINE=12)
+    def test_letter_calls_share_request_deadline(self):
+        start = time.monotonic()
+        with mock.patch('base.summaries.complete', side_effect=['Jane is great', 'Dear reader']) as complete:
+            self.client.get(self.url)
+        summary_call, letter_call = complete.call_args_list
+        self.assertEqual(summary_call[1]['deadline'], letter_call[1]['deadline'])
+        self.assertLessEqual(summary_call[1]['deadline'], time.monotonic() + 12)
+        self.assertGreater(summary_call[1]['deadline'], start)
+        self.assertEqual((summary_call[1]['retries'], letter_call[1]['retries']), (0, 0)) # no retries while the teacher waits
+
+    def test_letter_reuses_stored_summary(self):
+        StudentSummary.objects.create(student=self.student, kind='LETTER', input_hash='stale', text='Jane was great')
+        with mock.patch('base.summaries.complete', return_value='Dear reader') as complete:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self.client.get(self.url)
+            self.assertIn('Based on Jane was great', complete.call_args_list[0][0][0])
+        self.assertEqual(response.context['form'].initial['response'], 'Dear reader')
+        self.assertEqual(len(callbacks), 1) # the stale summary is refreshed in the background
+
+    def test_letter_template_when_unavailable(self):
+        with mock.patch('base.summaries.complete', side_effect=LLMUnavailable('unavailable')):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['message'], 'Exception block')
+        self.assertIn('Dear [Recipient\'s Name]', response.context['form'].initial['response'])
+
+    def test_async_letter(self):
+        url = reverse('base:recommendation-letter-async', kwargs={'student_name': self.student.name})
+        with mock.patch('base.summaries.complete', side_effect=['Jane is great', 'Dear reader']):
+            response = self.client.get(url)
+        self.assertTemplateUsed(response, 'recommendation-letter.html')
+        self.assertEqual(response.context['form'].initial['response'], 'Dear reader')
+        self.assertEqual(StudentSummary.objects.get(student=self.student, kind='LETTER').text, 'Jane is great')
+
+    def test_async_letter_requires_staff(self):
+        url = reverse('base:recommendation-letter-async', kwargs={'student_name': self.student.name})
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith('/login?next='))
+
+
+class LLMMetricsViewTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        User.objects.create_superuser(username='jam', email='jam@test.com', password='password123')
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_metrics(self):
+        metrics.cache_lookup('profile_summary', hit=True)
+        self.client.login(username='jam', password='password123')
+        response = self.client.get(reverse('base:llm-metrics'))
+        self.assertEqual(response.json()['profile_summary']['cache_hits'], 1)
+
+    def test_metrics_superuser_only(self):
+        User.objects.create_user(username='staff', password='password123')
+        self.client.login(username='staff', password='password123')
+        response = self.client.get(reverse('base:llm-metrics'))
+        self.assertEqual(response.status_code, 302)
+
 
 class GiveEndorsementTestCase(TestCase):
     def setUp(self):
@@ -9,22 +9,32 @@ urlpatterns = [
     path('login', views.login_request, name='login'),
     path('logout', views.logout_request, name='logout'),
     path('jam-admin', views.superuser_home, name='superuser-home'),
+    path('jam-admin/metrics', views.llm_metrics, name='llm-metrics'),
     path('school-register', views.school_register, name='school-register'),
     path('admin-register', views.admin_register, name='admin-register'),
     path('profile', views.staff_home, name='staff-home'),
     path('search-results', views.student_search, name='search-results'),
     path('student/<str:student_name>/', views.student_profile, name='student-profile'),
     path('student/<str:student_name>/write-review', views.create_review, name='write-review'),
+    path('student/<str:student_name>/standing', views.student_standing, name='student-standing'),
     path('student/<int:review_id>/edit-review', views.edit_review, name='edit-review'),
     path('student/<int:review_id>/delete-review', views.delete_review, name='delete-review'),
     path('student/<str:student_name>/endorsement/<str:skill>', views.give_endorsement, name='endorse'),
     path('<int:review_id>/vote/<str:vote_value>', views.vote_review, name='vote-review'),
+    path('api/review/<int:review_id>/vote/<str:vote_value>', views.vote_review_json, name='vote-review-json'),
+    path('api/student/<str:student_name>/endorsement/<str:skill>', views.give_endorsement_json, name='endorse-json'),
     path('leaderboard', views.student_ranking, name='leaderboard'),
+    path('leaderboard/export/<int:export_id>', views.leaderboard_export, name='leaderboard-export'),
+    path('leaderboard/export/<int:export_id>/status', views.leaderboard_export_status, name='leaderboard-export-status'),
+    path('leaderboard/export/<int:export_id>/download', views.leaderboard_export_download, name='leaderboard-export-download'),
+    path('leaderboard/download/<str:file_format>', views.leaderboard_stream, name='leaderboard-stream'),
     path('dashboard', views.admin_home, name='admin-home'),
     path('dashboard/student-upload', views.upload_csv, name='student-upload'),
+    path('dashboard/import/<int:job_id>/status', views.import_job_status, name='import-job-status'),
     path('dashboard/add-student', views.student_form, name='add-student'),
     path('unauthorized', views.unauthorized, name='unauthorized'),
     path('student/<str:student_name>/recommendation-letter', views.generate_recommendation, name='recommendation-letter'),
+    path('student/<str:student_name>/recommendation-letter/async', views.generate_recommendation_async, name='recommendation-letter-async'),
     path('student/recommendation-letter/<str:response>', views.download_recommendation, name='download-recommendation'),
     path('student/reviews/<str:student_name>', views.student_reviews, name='student-reviews')
 ]
@@ -1,25 +1,33 @@
 from django.shortcuts import render, redirect, reverse, get_object_or_404
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.contrib.auth.views import redirect_to_login
+from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
 from .forms import SchoolRegistrationForm, AdminRegistrationForm, StaffRegistrationForm, UploadCsvForm, StudentForm, ReviewForm, LetterForm
-from .models import Admin, Student, Staff, Review, Stats, Karma, Vote, Endorsement, EndorsementStats, Activity
-import csv
-import openai
-import os
-from dotenv import load_dotenv
-import random
+from .models import Admin, Student, Staff, Review, Stats, Karma, Vote, Endorsement, EndorsementStats, Activity, LeaderboardExport, ImportJob, SKILLS
+from .roster import run_import_job
+from .summaries import last_summary, request_summary_refresh
+from .letters import write_letter, write_letter_async
+from .metrics import metrics
+from .pagination import paginate, RECENT_FIRST
+from .voting import cast_vote, VOTE_VALUES
+from .endorsements import toggle_endorsement
+from . import tasks
+from .exports import render_pdf, request_leaderboard_export, leaderboard_rows, stream_csv, stream_ndjson
+from itertools import takewhile
 
 from django.http import FileResponse
-from reportlab.pdfgen import canvas
 
 import io
-from xhtml2pdf import pisa
-from django.template.loader import get_template
-from django.template import Context
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse, Http404
 
 
 
@@ -89,18 +97,9 @@ def unauthorized(request):
 @user_passes_test(lambda u: u.is_superuser, login_url='/unauthorized')
 def superuser_home(request):
     activities_set = Activity.objects.filter(user=request.user)
-    activities_list = sorted(list(activities_set), key=lambda x: x.created_at, reverse=True) # sort list into most-recent first
 
-    # pagination to show 8 items per page
-    paginator = Paginator(activities_list, per_page=8)
-    page = request.GET.get('page')
-
-    try:
-        activities = paginator.page(page)
-    except PageNotAnInteger:
-        activities = paginator.page(1)
-    except EmptyPage:
-        activities = paginator.page(paginator.num_pages)
+    # 8 items per page, most-recent first (see settings.NUMBERED_PAGES)
+    activities = paginate(request, activities_set, per_page=8, numbered=settings.NUMBERED_PAGES)
 
     context = {
         'activities' : activities
@@ -110,6 +109,16 @@ def superuser_home(request):
 
 
 
+# Text generation metrics of this process (latency percentiles, tokens, outcomes, summary cache hits), as JSON
+# metrics are kept per process, python manage.py llm_metrics reports on the saved calls of all processes
+
+@login_required()
+@user_passes_test(lambda u: u.is_superuser, login_url='/unauthorized')
+def llm_metrics(request):
+    return JsonResponse(metrics.snapshot())
+
+
+
 # School registration view - allows authenticated superusers to add new schools to the database
 
 @login_required()
@@ -184,13 +193,14 @@ def staff_home(request):
     staff = Staff.objects.get(user=user)
 
     # count the total number of upvotes and downvotes this staff user has received
-    reviews = Review.objects.filter(staff=staff)
-    num_reviews = reviews.count()
-    num_upvotes = 0
-    num_downvotes = 0
-    for review in reviews:
-        num_upvotes += review.stats.upvotes
-        num_downvotes += review.stats.downvotes
+    totals = Review.objects.filter(staff=staff).aggregate(
+        num_reviews=Count('id'),
+        num_upvotes=Coalesce(Sum('stats__upvotes'), 0),
+        num_downvotes=Coalesce(Sum('stats__downvotes'), 0)
+    )
+    num_reviews = totals['num_reviews']
+    num_upvotes = totals['num_upvotes']
+    num_downvotes = totals['num_downvotes']
     
     # count the number of skill endorsements this staff user has given
     endorsements = Endorsement.objects.filter(staff=staff)
@@ -203,18 +213,9 @@ def staff_home(request):
         if endorsement.teamwork: num_endorsements_given += 1
 
     activities_set = Activity.objects.filter(user=user)
-    activities_list = sorted(list(activities_set), key=lambda x: x.created_at, reverse=True)
 
-    # pagination to show 5 items per page
-    paginator = Paginator(activities_list, per_page=5)
-    page = request.GET.get('page')
-
-    try:
-        activities = paginator.page(page)
-    except PageNotAnInteger:
-        activities = paginator.page(1)
-    except EmptyPage:
-        activities = paginator.page(paginator.num_pages)
+    # 5 items per page, most-recent first (see settings.NUMBERED_PAGES)
+    activities = paginate(request, activities_set, per_page=5, numbered=settings.NUMBERED_PAGES)
 
     context = {
         'num_reviews' : num_reviews,
@@ -268,73 +269,28 @@ def student_profile(request, student_name):
     student = Student.objects.get(name=student_name, school=staff.school)
     karma = student.karma
     reviews = Review.objects.filter(student=student)
-    reviews_list = sorted(list(reviews), key=lambda x: x.created_at, reverse=True)
+    reviews_list = list(reviews.select_related('stats', 'staff__user').order_by('-created_at')[:3]) # the 3 latest reviews
     endorsement_stats = student.endorsementstats
 
-    # calculating the school highest for each skill
-    highest_endorsements = {
-        'leadership' : 0,
-        'respect' : 0,
-        'punctuality' : 0,
-        'participation' : 0,
-        'teamwork' : 0
-    }
-    all_endorsement_stats = [stats for stats in EndorsementStats.objects.all() if stats.school==staff.school]
-    for stats in all_endorsement_stats:
-        if stats.leadership > highest_endorsements['leadership']:
-            highest_endorsements['leadership'] = stats.leadership
-        if stats.respect > highest_endorsements['respect']:
-            highest_endorsements['respect'] = stats.respect
-        if stats.punctuality > highest_endorsements['punctuality']:
-            highest_endorsements['punctuality'] = stats.punctuality
-        if stats.participation > highest_endorsements['participation']:
-            highest_endorsements['participation'] = stats.participation
-        if stats.teamwork > highest_endorsements['teamwork']:
-            highest_endorsements['teamwork'] = stats.teamwork
+    # the school highest for each skill
+    highest_endorsements = EndorsementStats.school_highest(staff.school)
     
-    # record of whether or not this staff user has voted on this student's reviews
-    voted = []
-    for review in reviews_list:
-        if Vote.objects.filter(staff=staff, review=review).exists():
-            if Vote.objects.get(staff=staff, review=review).value == "UP":
-                voted.append("UP")
-            elif Vote.objects.get(staff=staff, review=review).value == "DOWN":
-                voted.append("DOWN")
-        else:
-            voted.append(None)
-
-    reviews_voted = list(zip(reviews_list, voted))
-    reviews_voted = reviews_voted[:3]
+    # record of whether or not this staff user has voted on these reviews
+    votes = Vote.values_for(staff, reviews_list)
+    reviews_voted = [(review, votes.get(review.pk)) for review in reviews_list]
     
-    # generating the student summary
-    if reviews:
-        load_dotenv()
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        reviews = reviews.order_by('-created_at')
-        if reviews.count()>10:  # only use the 10 latest reviews to reduce API cost
-            reviews=reviews[:10]
-        text = ""
-        for review in reviews:
-            text += review.text
-        prompt = f"Summarize '{text}'"
-        try:
-            response = openai.Completion.create(
-                model = "text-davinci-003",
-                prompt = prompt,
-                max_tokens = 1000,
-                temperature = 0
-            )
-            for result in response.choices:
-                summary = result.text    # to get and keep the last value in the {}
-
-        except:
-            summary = "Our servers are unavailable at this time"
+    # the last generated student summary, refreshed in the background when it is out of date
+    if reviews_list:
+        summary = last_summary(student, "PROFILE")
+        if summary is None:
+            summary = "The summary for this student is being generated, check back soon!"
     else:
         summary = "There's not much on this student..."
     
     context = {
         'student' : student,
         'karma' : karma,
+        'standing' : karma.standing(),
         'endorsement_stats' : endorsement_stats,
         'highest_endorsements' : highest_endorsements,
         'reviews' : reviews_voted,
@@ -344,6 +300,20 @@ def student_profile(request, student_name):
 
 
 
+# Rank and percentile of a student within their school, as JSON
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+def student_standing(request, student_name):
+    staff = Staff.objects.get(user=request.user)
+    student = get_object_or_404(Student, name=student_name, school=staff.school)
+    karma = student.karma
+    standing = karma.standing()
+    standing['score'] = karma.score
+    return JsonResponse(standing)
+
+
+
 # List and sort reviews for a student
 
 @login_required()
@@ -352,47 +322,26 @@ def student_reviews(request, student_name):
     staff = Staff.objects.get(user=request.user)
     student = Student.objects.get(name=student_name, school=staff.school)
     karma = student.karma
-    reviews = Review.objects.filter(student=student)
+    reviews = Review.objects.filter(student=student).select_related('stats', 'staff__user')
 
+    # every order ends with the most recent first, so pages are stable when values are tied
     order = request.GET.get('order')
-    if order:
-        if order == "HighestRating":
-            reviews = reviews.order_by('-rating')
-        elif order == "LowestRating":
-            reviews = reviews.order_by('rating')
-        elif order == "MostHelpful":
-            r = list(reviews)
-            r = r.sort(key=lambda x: x.stats.upvotes, reverse=True)
-        else:   #if "" or Most Recent
-            reviews = reviews.order_by('-created_at')
-    else:
-        reviews = reviews.order_by('-created_at')
-        
-    reviews_list = list(reviews)
-
-    # record of whether or not this staff user has voted on this student's reviews
-    voted = []
-    for review in reviews_list:
-        if Vote.objects.filter(staff=staff, review=review).exists():
-            if Vote.objects.get(staff=staff, review=review).value == "UP":
-                voted.append("UP")
-            elif Vote.objects.get(staff=staff, review=review).value == "DOWN":
-                voted.append("DOWN")
-        else:
-            voted.append(None)
-
-    reviews_voted = list(zip(reviews_list, voted))
-
-    # pagination to show 8 items per page
-    paginator = Paginator(reviews_voted, per_page=8)
-    page = request.GET.get('page')
-
-    try:
-        review_listing = paginator.page(page)
-    except PageNotAnInteger:
-        review_listing = paginator.page(1)
-    except EmptyPage:
-        review_listing = paginator.page(paginator.num_pages)
+    if order == "HighestRating":
+        ordering = ('-rating', '-created_at', '-id')
+    elif order == "LowestRating":
+        ordering = ('rating', '-created_at', '-id')
+    elif order == "MostHelpful":   # highest net votes first
+        reviews = Review.annotate_helpfulness(reviews)
+        ordering = ('-helpfulness', '-created_at', '-id')
+    else:   #if "" or Most Recent
+        ordering = RECENT_FIRST
+
+    # 8 items per page (see settings.NUMBERED_PAGES)
+    review_listing = paginate(request, reviews, per_page=8, ordering=ordering, numbered=settings.NUMBERED_PAGES)
+
+    # record of whether or not this staff user has voted on the reviews on this page
+    votes = Vote.values_for(staff, review_listing.object_list)
+    review_listing.object_list = [(review, votes.get(review.pk)) for review in review_listing.object_list]
 
     context = {
         'student' : student,
@@ -419,11 +368,11 @@ def create_review(request, student_name):
             review.staff = staff
             review.student = student
             review.is_good = review.rating >= 3
-            review.save()
-            karma = Karma.objects.get(student=student)
-            karma.update_score()
-            stats = Stats.objects.create(review=review) # every review object needs a stats object
-            stats.save()
+            with transaction.atomic():
+                review.save()
+                Karma.apply_delta(student, Karma.review_delta(review.is_good))
+                Stats.objects.create(review=review) # every review object needs a stats object
+                request_summary_refresh(student)
             activity = Activity.objects.create(
                 user=user,
                 message=f"You wrote a review for {student_name}.",
@@ -458,9 +407,15 @@ def edit_review(request, review_id):
             review = form.save(commit=False)
             review.is_good = review.rating >= 3
             review.edited = True
-            review.save()
-            karma = Karma.objects.get(student=review.student)
-            karma.update_score()
+            with transaction.atomic():
+                # read again under a row lock, so concurrent edits of the review apply their flips in turn
+                was_good = Review.objects.select_for_update().values_list('is_good', flat=True).get(pk=review.pk)
+                review.save()
+                if review.is_good != was_good:  # review flipped between good and bad
+                    net_votes = review.net_votes
+                    delta = Karma.review_delta(review.is_good, net_votes) - Karma.review_delta(was_good, net_votes)
+                    Karma.apply_delta(review.student, delta)
+                request_summary_refresh(review.student)
             activity = Activity.objects.create(
                 user=user,
                 message=f"You edited your review for {review.student.name}.",
@@ -487,9 +442,11 @@ def delete_review(request, review_id):
     staff = Staff.objects.get(user=user)
     if staff != review.staff:
         return redirect('base:unauthorized')
-    review.delete()
-    karma = Karma.objects.get(student=student)
-    karma.update_score()
+    with transaction.atomic():
+        delta = -Karma.review_delta(review.is_good, review.net_votes)
+        review.delete()
+        Karma.apply_delta(student, delta)
+        request_summary_refresh(student)
     activity = Activity.objects.create(
         user=user,
         message=f"You deleted your review for {student.name}.",
@@ -505,286 +462,131 @@ def delete_review(request, review_id):
 @login_required()
 @user_passes_test(is_staff, login_url='/unauthorized')
 def vote_review(request, review_id, vote_value):
+    if vote_value not in VOTE_VALUES:
+        raise Http404('Invalid vote')
+    review = get_object_or_404(Review.objects.select_related('student', 'staff__user'), id=review_id)
     if request.method == "POST":
-        review = Review.objects.get(id=review_id)
-        user = request.user
-        staff = Staff.objects.get(user=user)
-        try:
-            vote = Vote.objects.get(staff=staff, review=review)
-            if vote.value != vote_value:
-                vote.delete()
-                vote = Vote.objects.create(staff=staff, review=review, value=vote_value)
-                vote.save()
-                karma = Karma.objects.get(student=review.student)
-                karma.update_score()
-                if vote_value == "UP":
-                    activity = Activity.objects.create(
-                        user=review.staff.user,
-                        message=f"Your review for {review.student.name} received an upvote.",
-                        parameter=f"{review.student.name}"
-                    )
-                    activity.save()
-                elif vote_value == "DOWN":
-                    activity = Activity.objects.create(
-                        user=review.staff.user,
-                        message=f"Your review for {review.student.name} received a downvote.",
-                        parameter=f"{review.student.name}"
-                    )
-                    activity.save()
-            elif vote.value == vote_value:
-                vote.delete()
-                karma = Karma.objects.get(student=review.student)
-                karma.update_score()
-        except Vote.DoesNotExist:
-            vote = Vote.objects.create(staff=staff, review=review, value=vote_value)
-            vote.save()
-            karma = Karma.objects.get(student=review.student)
-            karma.update_score()
-            if vote_value == "UP":
-                activity = Activity.objects.create(
-                    user=review.staff.user,
-                    message=f"Your review for {review.student.name} received an upvote.",
-                    parameter=f"{review.student.name}"
-                )
-                activity.save()
-            elif vote_value == "DOWN":
-                activity = Activity.objects.create(
-                    user=review.staff.user,
-                    message=f"Your review for {review.student.name} received a downvote.",
-                    parameter=f"{review.student.name}"
-                )
-                activity.save()
+        staff = Staff.objects.get(user=request.user)
+        result = cast_vote(staff, review, vote_value)
+        record_vote_activity(review, result)
     return redirect('base:student-profile', student_name=review.student.name)
 
 
+# Vote on a review from the student profile or reviews page, answers with the review's new counters
+# and the student's new karma instead of reloading the page
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+@require_POST
+def vote_review_json(request, review_id, vote_value):
+    if vote_value not in VOTE_VALUES:
+        raise Http404('Invalid vote')
+    staff = Staff.objects.get(user=request.user)
+    review = get_object_or_404(Review.objects.select_related('student', 'staff__user'), id=review_id, student__school=staff.school)
+    result = cast_vote(staff, review, vote_value)
+    record_vote_activity(review, result)
+    return JsonResponse({
+        'review' : review.id,
+        'vote' : result.value,
+        'upvotes' : result.upvotes,
+        'downvotes' : result.downvotes,
+        'net_votes' : result.upvotes - result.downvotes,
+        'karma' : result.karma
+    })
+
+
+# lets the author of the review know it received a new vote
+
+def record_vote_activity(review, result):
+    if result.value == "UP":
+        Activity.objects.create(
+            user=review.staff.user,
+            message=f"Your review for {review.student.name} received an upvote.",
+            parameter=f"{review.student.name}"
+        )
+    elif result.value == "DOWN":
+        Activity.objects.create(
+            user=review.staff.user,
+            message=f"Your review for {review.student.name} received a downvote.",
+            parameter=f"{review.student.name}"
+        )
+
+
 
 # Give a student a skill endorsement
 
 @login_required()
 @user_passes_test(is_staff, login_url='/unauthorized')
 def give_endorsement(request, student_name, skill):
+    if skill not in SKILLS:
+        raise Http404('Invalid skill')
     if request.method == "POST":
-        user = request.user
-        staff = Staff.objects.get(user=user)
-        student = Student.objects.get(name=student_name, school=staff.school)
-        try:
-            endorsements = Endorsement.objects.get(student=student, staff=staff)
-            if skill == 'leadership':
-                endorsements.leadership = not endorsements.leadership
-                if endorsements.leadership:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You gave a leadership endorsement to {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-                else:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You removed a leadership endorsement from {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-            elif skill == 'respect':
-                endorsements.respect = not endorsements.respect
-                if endorsements.respect:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You gave a respect endorsement to {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-                else:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You removed a respect endorsement from {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-            elif skill == 'punctuality':
-                endorsements.punctuality = not endorsements.punctuality
-                if endorsements.punctuality:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You gave a punctuality endorsement to {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-                else:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You removed a punctuality endorsement from {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-            elif skill == 'participation':
-                endorsements.participation = not endorsements.participation
-                if endorsements.participation:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You gave a participation endorsement to {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-                else:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You removed a participation endorsement from {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-            elif skill == 'teamwork':
-                endorsements.teamwork = not endorsements.teamwork
-                if endorsements.teamwork:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You gave a teamwork endorsement to {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-                else:
-                    activity = Activity.objects.create(
-                        user=user,
-                        message=f"You removed a teamwork endorsement from {student_name}.",
-                        parameter=f"{student.name}"
-                    )
-                    activity.save()
-            endorsements.save()
-            karma = Karma.objects.get(student=student)
-            karma.update_score()
-        except Endorsement.DoesNotExist:
-            endorsements = Endorsement.objects.create(student=student, staff=staff)
-            if skill == 'leadership':
-                endorsements.leadership = True
-                activity = Activity.objects.create(
-                    user=user,
-                    message=f"You gave a leadership endorsement to {student_name}.",
-                    parameter=f"{student.name}"
-                )
-                activity.save()
-            elif skill == 'respect':
-                endorsements.respect = True
-                activity = Activity.objects.create(
-                    user=user,
-                    message=f"You gave a respect endorsement to {student_name}.",
-                    parameter=f"{student.name}"
-                )
-                activity.save()
-            elif skill == 'punctuality':
-                endorsements.punctuality = True
-                activity = Activity.objects.create(
-                    user=user,
-                    message=f"You gave a punctuality endorsement to {student_name}.",
-                    parameter=f"{student.name}"
-                )
-                activity.save()
-            elif skill == 'participation':
-                endorsements.participation = True
-                activity = Activity.objects.create(
-                    user=user,
-                    message=f"You gave a participation endorsement to {student_name}.",
-                    parameter=f"{student.name}"
-                )
-                activity.save()
-            elif skill == 'teamwork':
-                endorsements.teamwork = True
-                activity = Activity.objects.create(
-                    user=user,
-                    message=f"You gave a teamwork endorsement to {student_name}.",
-                    parameter=f"{student.name}"
-                )
-                activity.save()
-            endorsements.save()
-            karma = Karma.objects.get(student=student)
-            karma.update_score()
+        staff = Staff.objects.get(user=request.user)
+        student = get_object_or_404(Student, name=student_name, school=staff.school)
+        result = toggle_endorsement(staff, student, skill)
+        record_endorsement_activity(request.user, student, result)
     return redirect('base:student-profile', student_name=student_name)
 
 
+# Give a student a skill endorsement from their profile, answers with the skill's new count and the
+# student's new karma instead of reloading the page
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+@require_POST
+def give_endorsement_json(request, student_name, skill):
+    if skill not in SKILLS:
+        raise Http404('Invalid skill')
+    staff = Staff.objects.get(user=request.user)
+    student = get_object_or_404(Student, name=student_name, school=staff.school)
+    result = toggle_endorsement(staff, student, skill)
+    record_endorsement_activity(request.user, student, result)
+    return JsonResponse({
+        'skill' : skill,
+        'endorsed' : result.given,
+        'count' : result.count,
+        'karma' : result.karma
+    })
+
+
+def record_endorsement_activity(user, student, result):
+    if result.given:
+        message = f"You gave a {result.skill} endorsement to {student.name}."
+    else:
+        message = f"You removed a {result.skill} endorsement from {student.name}."
+    Activity.objects.create(user=user, message=message, parameter=f"{student.name}")
+
+
 
 # Karma Leaderboard
 
 @login_required()
 @user_passes_test(is_staff, login_url='/unauthorized')
 def student_ranking(request):
-    staff = Staff.objects.get(user=request.user)
-    students = Student.objects.filter(school=staff.school).order_by('-karma__score', 'name')
-    student_list = list(students)
-    ranking = []
-
-    # calculating student rank when multiple students have the same rank/karma score
-    for index, student in enumerate(student_list):
-        if len(student_list) == 1:
-            rank = 1
-            ranking.append(rank)
-        if index < len(student_list)-1:
-            if index == 0:
-                rank = 1
-                ranking.append(rank)
-            if student_list[index+1].karma.score == student.karma.score:
-                ranking.append(rank)
-            else:
-                rank = len(ranking) + 1
-                ranking.append(rank)
-        else:
-            if student.karma.score == student_list[index-1].karma.score:
-                ranking.append(rank)
-            else:
-                rank = len(ranking) + 1
-                ranking.append(rank)
-
-    students_ranking = list(zip(student_list, ranking))
+    staff = Staff.objects.select_related('school').get(user=request.user)
+    students = Student.leaderboard_snapshot(staff.school)  # ranks are calculated by the database and cached
+    school_total = len(students)
+    query = 0
 
-    query = request.GET.get('query')
-    if query:
+    target = request.GET.get('query')
+    if target:
         try:
-            target = int(query)
-            if target > len(students):
-                messages.error(request, f'Enter a number between 1 and {students.count()}')
+            target = int(target)
+            if target < 1 or target > school_total:
+                messages.error(request, f'Enter a number between 1 and {school_total}')
             else:
-                queried_students_ranking = [ (s, r) for (s, r) in students_ranking if r <= target ]
-
-                if request.GET.get('download') == 'download':
-                    context = {
-                        'students' : queried_students_ranking,
-                        'school_total' : len(students),
-                        'query' : query,
-                        'school' : staff.school.name
-                    }
-                    filename = f'{staff.school.name}_student_leaderboard_top{query}.pdf'
-                    return render_to_pdf('download-leaderboard.html', context, name=filename)
-
-                # pagination to show 10 items per page
-                paginator = Paginator(queried_students_ranking, per_page=10)
-                page = request.GET.get('page')
-
-                try:
-                    students_page = paginator.page(page)
-                except PageNotAnInteger:
-                    students_page = paginator.page(1)
-                except EmptyPage:
-                    students_page = paginator.page(paginator.num_pages)
-                
-                context = {
-                    'students' : students_page,
-                    'school_total' : len(students),
-                    'query' : query,
-                    'school' : staff.school.name
-                }
-                return render(request, 'leaderboard.html', context)
-        except:
+                students = list(takewhile(lambda student: student.rank <= target, students)) # snapshot is ordered by rank
+                query = target
+        except ValueError:
             messages.error(request, 'Oops, an unexpected error occurred :(')
-    
+
+    # the PDF is rendered by the background worker, the user waits for it on the export page
     if request.GET.get('download') == 'download':
-        context = {
-            'students' : students_ranking,
-            'school_total' : len(students),
-            'query' : 0,
-            'school' : staff.school.name
-        }
-        filename = f'{staff.school.name}_student_leaderboard.pdf'
-        return render_to_pdf('download-leaderboard.html', context, name=filename)
-    
-    paginator = Paginator(students_ranking, per_page=10)
+        export = request_leaderboard_export(staff.school, top=query)
+        return redirect('base:leaderboard-export', export_id=export.id)
+
+    # pagination to show 10 items per page
+    paginator = Paginator(students, per_page=10)
     page = request.GET.get('page')
 
     try:
@@ -793,11 +595,11 @@ def student_ranking(request):
         students_page = paginator.page(1)
     except EmptyPage:
         students_page = paginator.page(paginator.num_pages)
-    
+
     context = {
         'students' : students_page,
-        'school_total' : len(students),
-        'query' : 0,
+        'school_total' : school_total,
+        'query' : query,
         'school' : staff.school.name
     }
 
@@ -810,154 +612,133 @@ def student_ranking(request):
 @login_required()
 @user_passes_test(is_staff, login_url='/unauthorized')
 def generate_recommendation(request, student_name):
-    load_dotenv()
-    openai.api_key = os.getenv('OPENAI_API_KEY')
-    staff = Staff.objects.get(user=request.user)
-    student = Student.objects.get(name=student_name, school=staff.school)
-    karma = student.karma
+    if request.method == 'POST':
+        response = request.POST['response']
+        return redirect ('base:download-recommendation', response=response)
 
-    students = Student.objects.filter(school=staff.school).order_by('-karma__score')
-    top_student = students[0] # get student with highest karma score
-    max_karma = top_student.karma
-    rank = karma.score/max_karma.score
-
-    set = Review.objects.filter(student=student, is_good=True).order_by('-rating')   # get positive reviews, chatGPT wont write a recommendation letter with negative reviews
-    if set: 
-        if set.count()>5:   # reduce set size to 5 for cheaper API calls
-            set = set[:5]
-        text = ""
-        for r in set:
-            text += r.text
-        prompt = f"Summarize '{text}'"
-        try:
-            response = openai.Completion.create(
-                model = "text-davinci-003",
-                prompt = prompt,
-                max_tokens = 1000,
-                temperature = 0 
-            )
-            for result in response.choices:
-                summary = result.text    #to get and keep the last value in the {}
-        except:
-            summary = set[:1]
-
-    highest_endorsements = {
-        'leadership' : 0,
-        'respect' : 0,
-        'punctuality' : 0,
-        'participation' : 0,
-        'teamwork' : 0
-    }
-    endorsement_stats = student.endorsementstats
+    staff = Staff.objects.select_related('user', 'school').get(user=request.user)
+    student = Student.objects.get(name=student_name, school=staff.school)
+    text, is_template = write_letter(staff, student)
+    return render(request, 'recommendation-letter.html', letter_context(student, text, is_template))
 
-    all_endorsement_stats = [stats for stats in EndorsementStats.objects.all() if stats.school==staff.school]
-    for stats in all_endorsement_stats:
-        if stats.leadership > highest_endorsements['leadership']:
-            highest_endorsements['leadership'] = stats.leadership
-        if stats.respect > highest_endorsements['respect']:
-            highest_endorsements['respect'] = stats.respect
-        if stats.punctuality > highest_endorsements['punctuality']:
-            highest_endorsements['punctuality'] = stats.punctuality
-        if stats.participation > highest_endorsements['participation']:
-            highest_endorsements['participation'] = stats.participation
-        if stats.teamwork > highest_endorsements['teamwork']:
-            highest_endorsements['teamwork'] = stats.teamwork
-
-    qualities = []  #will be used in templates if OpenAI servers are busy
-    if endorsement_stats.leadership>=0.5*highest_endorsements['leadership']: # record qualities if the are at least half of the highest in the school
-        qualities.append("leadership")
-    if endorsement_stats.respect>=0.5*highest_endorsements['respect']:
-        qualities.append("respect")
-    if endorsement_stats.punctuality>=0.5*highest_endorsements['punctuality']:
-        qualities.append("punctuality")
-    if endorsement_stats.participation>=0.5*highest_endorsements['participation']:
-        qualities.append("participation")
-    if endorsement_stats.teamwork>=0.5*highest_endorsements['teamwork']:
-        qualities.append("teamwork")
-    
-    q = ""
-    if len(qualities)==0:
-        q = "[qualities/traits/skills]"
-    else:
-        length = len(qualities)
-        for i in range (length-1):
-            q += qualities[i] +", "
-        q += "and " + qualities[length-1]
 
-    if rank>=0.5:   # Excellent
-        keywords = ["excellent", "exemplary", "outstanding", "remarkable", "model"]
-    else:   # rank<0.5, fair/good
-        keywords = ["decent", "suitable", "average", "standard", "passable", "adequate", "moderate"]
+def letter_context(student, text, is_template):
+    context = {
+        'response' : text
+    }
+    form = LetterForm(context, initial=context)
 
-    # prompts will be used to autogenerate a recommendation letter using the OpenAI API.
-    # templates will be used when the OPENAI servers are busy. They will require manual completion by teachers in some parts
+    context = {
+        'form' : form,
+        'student' : student
+    }
+    if is_template:
+        context['message'] = "Exception block"
+    return context
 
-    if set:
-        prompt = f"Based on {summary}, write a recommendation letter from {staff.user.get_full_name()} for a student named {student_name} who attended {staff.school} using words like {random.sample(keywords,3)}"
-    else:
-        prompt = f"Write a recommendation letter from {staff.user.get_full_name()} for a student named {student_name} who attended {staff.school} using words like {random.sample(keywords,3)}"
-    
-    template1 = f"Dear [Recipient's Name],\n\nI am writing to recommend {student_name} for [Purpose of Recommendation] for which he/she has applied. I have had the pleasure of [teaching/supervising/working with] {student_name} for [length of time] at {staff.school}.\n\n During this time, I have had the opportunity to observe {student_name}'s exceptional {q}, which make him/her an outstanding candidate for [Purpose of Recommendation]. Specifically, [provide specific examples of the student's accomplishments or characteristics that demonstrate their suitability for the program or opportunity].\n\nIn addition to {student_name}'s exceptional {q}, he/she also possesses [other relevant qualities or characteristics, such as strong work ethic, leadership ability, creativity, or interpersonal skills]. These attributes have been critical to his/her success and have helped [him/her] to stand out as an exceptional student. Overall, I believe that {student_name} would be an excellent candidate for [Purpose of Recommendation], and I wholeheartedly endorse his/her application.\n\nIf you have any further questions or require additional information, please do not hesitate to contact me.\n\n Sincerely,\n{staff.user.get_full_name()}"
 
-    template2 = f"Dear [Recipient's Name],\n\nI am writing to recommend {student_name} for [Purpose of Recommendation] for which he/she has applied. I have had the pleasure of [teaching/supervising/working with] {student_name} for [length of time] at {staff.school}.\n\n During this time, I have had the opportunity to observe {student_name}'s good {q}, which make him/her a fair candidate for [Purpose of Recommendation]. Specifically, [provide specific examples of the student's accomplishments or characteristics that demonstrate their suitability for the program or opportunity].\n\nIn addition to {student_name}'s good {q}, he/she also possesses [other relevant qualities or characteristics, such as strong work ethic, leadership ability, creativity, or interpersonal skills]. These attributes have been instrumental in his/her success and have helped identify [him/her] as a good student. Overall, I believe that {student_name} would be a suitable candidate for [Purpose of Recommendation], and I endorse his/her application.\n\nIf you have any further questions or require additional information, please do not hesitate to contact me.\n\n Sincerely,\n{staff.user.get_full_name()}"
 
-    if request.method=='GET':
-        try:
-            response = openai.Completion.create(
-                model="text-davinci-003",
-                prompt= prompt,
-                max_tokens=1000,
-                temperature=0
-            )
-            for result in response.choices:
-                text = result.text    # to get and keep the last value in the {}
-
-            context = {
-                'response' : text
-            }
-            form = LetterForm(context, initial=context)
-
-            context = {
-                'form' : form,
-                'student' : student
-            }
-            return render (request, 'recommendation-letter.html', context)
-        except: # switch to template if server is busy
-            if (rank>=0.5):
-                template = template1
-            else:
-                template = template2
+# Async variant of generate_recommendation, for deployments served through ASGI (see student_tracker/asgi.py)
+# the login_required and user_passes_test decorators don't support async views, so access is checked here
 
-            context = {
-                'response' : template
-            }
-            form = LetterForm(context, initial=context)
+def recommendation_staff(request):
+    if not request.user.is_authenticated or not is_staff(request.user):
+        return None
+    return Staff.objects.select_related('user', 'school').get(user=request.user)
 
-            context = {
-                'form' : form,
-                'student' : student,
-                'message' : "Exception block"
-            }
-            return render (request, 'recommendation-letter.html', context)
 
-    else:    #request is post
+async def generate_recommendation_async(request, student_name):
+    staff = await sync_to_async(recommendation_staff)(request)
+    if staff is None:
+        if await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect('/unauthorized')
+        return redirect_to_login(request.get_full_path())
+    if request.method == 'POST':
         response = request.POST['response']
         return redirect ('base:download-recommendation', response=response)
 
+    student = await sync_to_async(get_object_or_404)(Student, name=student_name, school=staff.school)
+    text, is_template = await write_letter_async(staff, student)
+    return await sync_to_async(render)(request, 'recommendation-letter.html', letter_context(student, text, is_template))
+
 
 
 def render_to_pdf(template_src, context_dict, name):
-    template = get_template(template_src)
-    html  = template.render(context_dict)
-    result = io.BytesIO()
-    pdf = pisa.pisaDocument(io.BytesIO(html.encode("ISO-8859-1")), result)
-    if not pdf.err:
-        result.seek(0)
-        return FileResponse(result, as_attachment=True, filename=name)
+    pdf = render_pdf(template_src, context_dict)
+    if pdf is not None:
+        return FileResponse(io.BytesIO(pdf), as_attachment=True, filename=name)
     return
 
 
 
+# Leaderboard as a streamed CSV or NDJSON file (rank, name, karma and per-skill endorsements)
+
+STREAM_FORMATS = {
+    'csv' : (stream_csv, 'text/csv'),
+    'ndjson' : (stream_ndjson, 'application/x-ndjson')
+}
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+def leaderboard_stream(request, file_format):
+    if file_format not in STREAM_FORMATS:
+        raise Http404
+    staff = Staff.objects.select_related('school').get(user=request.user)
+    top = 0
+    target = request.GET.get('query')
+    if target:
+        # validated like student_ranking's query, the rows are read while the response is streamed
+        school_total = Student.objects.filter(school=staff.school).count()
+        try:
+            top = int(target)
+        except ValueError:
+            return HttpResponseBadRequest(f'Enter a number between 1 and {school_total}')
+        if top < 1 or top > school_total:
+            return HttpResponseBadRequest(f'Enter a number between 1 and {school_total}')
+
+    stream, content_type = STREAM_FORMATS[file_format]
+    response = StreamingHttpResponse(stream(leaderboard_rows(staff.school, top=top)), content_type=content_type)
+    suffix = f'_top{top}' if top else ''
+    filename = f'{staff.school.name}_student_leaderboard{suffix}.{file_format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+
+# Leaderboard PDF export page - shows the progress of the background render, then the download link
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+def leaderboard_export(request, export_id):
+    staff = Staff.objects.get(user=request.user)
+    export = get_object_or_404(LeaderboardExport.objects.defer('pdf'), id=export_id, school=staff.school)
+    return render(request, 'leaderboard-export.html', {'export' : export})
+
+
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+def leaderboard_export_status(request, export_id):
+    staff = Staff.objects.get(user=request.user)
+    export = LeaderboardExport.objects.defer('pdf').filter(id=export_id, school=staff.school).first()
+    if export is None:  # eg. a stale export that was cleaned up, the page offers to request it again
+        return JsonResponse({'status' : 'MISSING', 'download_url' : None}, status=404)
+    return JsonResponse({
+        'status' : export.status,
+        'download_url' : reverse('base:leaderboard-export-download', args=[export.id]) if export.status == "DONE" else None
+    })
+
+
+
+@login_required()
+@user_passes_test(is_staff, login_url='/unauthorized')
+def leaderboard_export_download(request, export_id):
+    staff = Staff.objects.get(user=request.user)
+    export = get_object_or_404(LeaderboardExport, id=export_id, school=staff.school, status="DONE")
+    return FileResponse(io.BytesIO(export.pdf), as_attachment=True, filename=export.filename)
+
+
+
 @login_required()
 @user_passes_test(is_staff, login_url='/unauthorized')
 def download_recommendation (request, response):
@@ -983,10 +764,13 @@ def download_recommendation (request, response):
 def admin_home(request):
     csv_form = UploadCsvForm()
     student_form = StudentForm()
+    admin = Admin.objects.get(user=request.user)
+    import_jobs = ImportJob.objects.filter(school=admin.school).order_by('-created_at')[:5]
 
     context = {
         'csv_form' : csv_form,
-        'student_form' : student_form
+        'student_form' : student_form,
+        'import_jobs' : import_jobs
     }
 
     return render(request, 'admin-home.html', context)
@@ -1008,26 +792,26 @@ def upload_csv(request):
             if not csv_file.name.endswith('.csv'):
                 form.add_error('csv_file', 'File is not a CSV')
             else:
-                try:
-                    decoded_file = csv_file.read().decode('utf-8-sig').splitlines()
-                    reader = csv.DictReader(decoded_file)
-                    for row in reader:
-                        name = row['name']
-                        if not Student.objects.filter(name=name, school=admin.school).exists():
-                            student = Student.objects.create(name=name, school=admin.school)
-                            student.save()
-                            karma = Karma.objects.create(student=student) # create a karma object for each student
-                            karma.save()
-                            endorsement_stats = EndorsementStats.objects.create(student=student)  # create an endorsementstats object for each student
-                            endorsement_stats.save()
-                    messages.success(request, 'Students from your csv file have been successfully added!')
-                    return redirect('base:admin-home')
-                except Exception as e:
-                    form.add_error('csv_file', 'Error processing file: ' + str(e))
+                # the file is imported by the background worker, the dashboard shows the job's progress
+                job = ImportJob.objects.create(school=admin.school, csv_file=csv_file, filename=csv_file.name)
+                tasks.enqueue(run_import_job, job.pk)
+                messages.success(request, f'{csv_file.name} has been uploaded, your students are being added!')
+                return redirect('base:admin-home')
     return redirect('base:admin-home')
 
 
 
+# JSON progress of a roster import job, polled by the admin dashboard
+
+@login_required()
+@user_passes_test(is_admin, login_url='/unauthorized')
+def import_job_status(request, job_id):
+    admin = Admin.objects.get(user=request.user)
+    job = get_object_or_404(ImportJob, id=job_id, school=admin.school)
+    return JsonResponse(job.progress())
+
+
+
 # View to allow admin users to add students to the system "one-by-one"/manually
 @login_required()
 @user_passes_test(is_admin, login_url='/unauthorized')
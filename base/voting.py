@@ -0,0 +1,62 @@
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import Vote, Stats, Karma
+
+
+# Votes on reviews
+# A staff member has at most one vote per review (unique on staff, review). Voting the same value
+# again removes the vote, voting the other value switches it. The vote row is locked with
+# select_for_update for the whole change, so concurrent clicks by the same staff member are applied
+# one after the other, and the review counters and karma are updated in the same transaction
+
+VOTE_VALUES = dict(Vote.VOTE_TYPE)
+
+
+# the outcome of a vote: the staff member's vote before and after, and the review's new counters
+# and the student's new karma
+
+class VoteResult:
+    def __init__(self, old_value, value, upvotes, downvotes, karma):
+        self.old_value = old_value
+        self.value = value
+        self.upvotes = upvotes
+        self.downvotes = downvotes
+        self.karma = karma
+
+    @property
+    def changed(self):
+        return self.value != self.old_value
+
+
+# Casts staff's vote ("UP" or "DOWN") on the review, see above. Returns a VoteResult
+
+def cast_vote(staff, review, value):
+    if value not in VOTE_VALUES:
+        raise ValueError(f'Invalid vote {value!r}')
+
+    with transaction.atomic():
+        vote = Vote.objects.select_for_update().filter(staff=staff, review=review).first()
+        if vote is None:
+            try:
+                with transaction.atomic():
+                    Vote.objects.create(staff=staff, review=review, value=value)
+                old_value, new_value = None, value
+            except IntegrityError:
+                # a concurrent click voted first, apply this one on top of it
+                vote = Vote.objects.select_for_update().get(staff=staff, review=review)
+
+        if vote is not None:
+            old_value = vote.value
+            if old_value == value:
+                new_value = None
+                vote.delete()
+            else:
+                new_value = value
+                Vote.objects.filter(pk=vote.pk).update(value=new_value, time=timezone.now())
+
+        Stats.record_vote(review, old_value, new_value)
+        Karma.apply_delta(review.student, Karma.vote_delta(review.is_good, old_value, new_value))
+        upvotes, downvotes = Stats.objects.filter(review=review).values_list('upvotes', 'downvotes').first() or (0, 0)
+        karma = Karma.objects.filter(student_id=review.student_id).values_list('score', flat=True).first()
+
+    return VoteResult(old_value, new_value, upvotes, downvotes, karma)
@@ -3,6 +3,10 @@ ASGI config for student_tracker project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Served through an ASGI server (eg. uvicorn or daphne), async views such as
+base.views.generate_recommendation_async wait on the LLM backend without holding
+a worker thread for the whole request.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 """
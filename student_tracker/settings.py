@@ -14,6 +14,7 @@ from pathlib import Path
 from django.contrib.messages import constants as messages
 import os
 import dj_database_url
+from dotenv import dotenv_values
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.humanize',
     'crispy_forms',
     'crispy_bootstrap4',
     'mathfilters',
@@ -123,6 +125,82 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# the default is a per-process memory cache; when running several gunicorn workers,
+# point this at a shared cache so invalidations are seen by every worker
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+
+# upper bound on how stale the cached school highest endorsements can be in another worker
+HIGHEST_ENDORSEMENTS_CACHE_TIMEOUT = 300
+
+# leaderboard snapshots are keyed by the school's karma version, so they never go stale
+LEADERBOARD_CACHE_TIMEOUT = 60 * 60
+
+# seconds a finished PDF export of an older karma version is kept, so it can still be downloaded
+LEADERBOARD_EXPORT_RETENTION = 10 * 60
+
+# activity feeds and review listings page with a cursor (?cursor=...), which costs the same for any page;
+# set NUMBERED_PAGES to show page numbers instead (each page then counts the rows and skips with OFFSET)
+NUMBERED_PAGES = os.environ.get('NUMBERED_PAGES', '') == 'True'
+
+# Background tasks (see base/tasks.py)
+# jobs run in a thread pool inside each web process, set BACKGROUND_TASKS_EAGER to run them synchronously
+
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 2))
+
+BACKGROUND_TASKS_EAGER = os.environ.get('BACKGROUND_TASKS_EAGER', '') == 'True'
+
+# processes for CPU bound work such as PDF rendering
+BACKGROUND_PROCESSES = int(os.environ.get('BACKGROUND_PROCESSES', 1))
+
+# seconds after which a saved job that is still running is considered abandoned and is run again
+# by python manage.py run_jobs
+BACKGROUND_JOB_TIMEOUT = int(os.environ.get('BACKGROUND_JOB_TIMEOUT', 15 * 60))
+
+# AI text generation (see base/llm.py)
+# LLM_BACKEND is 'openai', or 'stub' to run without OpenAI (the stub's latency and failure rate are configurable)
+
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'openai')
+
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY') or dotenv_values(BASE_DIR / '.env').get('OPENAI_API_KEY')
+
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', 'text-davinci-003')
+
+LLM_STUB_LATENCY = float(os.environ.get('LLM_STUB_LATENCY', 0))
+
+LLM_STUB_FAILURE_RATE = float(os.environ.get('LLM_STUB_FAILURE_RATE', 0))
+
+# prompt sizes in tokens (see base/prompts.py): the most review text put into a prompt, and the model's context size
+LLM_INPUT_TOKEN_BUDGET = int(os.environ.get('LLM_INPUT_TOKEN_BUDGET', 1500))
+
+LLM_CONTEXT_TOKENS = 4097
+
+# seconds per attempt, number of retries after a failed attempt and base delay between them
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 10))
+
+LLM_RETRIES = int(os.environ.get('LLM_RETRIES', 2))
+
+LLM_RETRY_BACKOFF = 0.5
+
+# seconds a call may take in total, retries included (background tasks)
+LLM_DEADLINE = float(os.environ.get('LLM_DEADLINE', 25))
+
+# seconds a web request may spend on text generation in total (all its calls, and waiting on calls
+# made by other requests), well under gunicorn's 30 second worker timeout. No retries on this path
+LLM_REQUEST_DEADLINE = float(os.environ.get('LLM_REQUEST_DEADLINE', 12))
+
+# consecutive failures before calls fail fast, and seconds before a call is tried again
+LLM_BREAKER_THRESHOLD = 5
+
+LLM_BREAKER_RESET_TIMEOUT = 30
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -165,6 +243,11 @@ STATICFILES_DIRS= [
     BASE_DIR / 'static'
 ]
 
+# Uploaded files (roster csv files waiting to be imported)
+# python manage.py run_jobs only imports the files it can read here, so share it with the worker
+
+MEDIA_ROOT = os.environ.get('DJANGO_MEDIA_ROOT', BASE_DIR / 'media')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 